@@ -1,20 +1,26 @@
-import json, urllib
-
 from django.conf import settings
 from django.core import exceptions
-from django.utils import crypto, importlib
+from django.utils import importlib
+
+import bson
+from pymongo import errors
 
-from mongoengine import queryset
+import mongoengine
 from mongoengine.django import auth
 
 import tweepy
 
 from django_browserid import auth as browserid_auth, base as browserid_base
 
-from . import models
+from . import circuitbreaker, models, throttle, transport, usercache, userview
 
+# Filled with an ObjectId (24 characters), so it has to fit into maximal username length of 30 characters
 LAZYUSER_USERNAME_TEMPLATE = 'guest-%s'
 USER_CLASS = 'mongo_auth.models.User'
+# Load only summaries of third-party profile data for the per-request user, the rest on first access
+USER_DEFER_PROFILE_DATA = False
+# Return a compact read-only view of the user document as the per-request user, constructing the user object on demand
+USER_VIEW = False
 
 def get_class(path):
     i = path.rfind('.')
@@ -34,6 +40,9 @@ def get_class(path):
 
 User = get_class(getattr(settings, 'USER_CLASS', USER_CLASS))
 
+def is_duplicate_key_error(error):
+    return getattr(error, 'code', None) in (11000, 11001) or 'E11000' in str(error)
+
 class MongoEngineBackend(auth.MongoEngineBackend):
     # TODO: Implement object permission support
     supports_object_permissions = False
@@ -43,54 +52,211 @@ class MongoEngineBackend(auth.MongoEngineBackend):
     supports_inactive_user = False
 
     def authenticate(self, username, password):
-        user = self.user_class.objects(username__iexact=username).first()
+        # We reject throttled attempts before any query or password hashing
+        if not throttle.allow('username', username.lower() if username else None):
+            return None
+
+        user = self.user_class.objects(self.user_class.username_query(username)).first()
         if user:
             if password and user.check_password(password):
                 return user
         return None
 
-    def get_user(self, user_id):
+    def get_user_son(self, user_id):
+        """
+        Returns raw user document for the given user id, or ``None``.
+        """
+
         try:
-            return self.user_class.objects.with_id(user_id)
-        except self.user_class.DoesNotExist:
+            query = self.user_class.objects(pk=user_id)._query
+        except mongoengine.ValidationError:
             return None
+        if getattr(settings, 'USER_DEFER_PROFILE_DATA', USER_DEFER_PROFILE_DATA):
+            return self.user_class._get_collection().find_one(query, self.user_class.get_deferred_projection())
+        return self.user_class._get_collection().find_one(query)
+
+    def get_user(self, user_id):
+        cache = usercache.get_cache()
+        if cache is None:
+            son = self.get_user_son(user_id)
+        else:
+            son = cache.get(user_id, self.get_user_son)
+
+        if son is None:
+            return None
+        if getattr(settings, 'USER_VIEW', USER_VIEW):
+            return userview.UserView(self.user_class, son, self.user_from_son)
+        return self.user_from_son(son)
+
+    def user_from_son(self, son):
+        user = self.user_class._from_son(son)
+        if getattr(settings, 'USER_DEFER_PROFILE_DATA', USER_DEFER_PROFILE_DATA):
+            user.defer_fields(models.PROFILE_DATA_SUMMARY_KEYS.keys())
+        return user
 
     @property
     def user_class(self):
         return User
 
-class FacebookBackend(MongoEngineBackend):
+def prefetch_users(users):
+    """
+    Returns read-only user views for given user ids or references, in the same
+    order, loaded with one query. Only fields needed to display users are loaded,
+    the whole user document is loaded when any other field is accessed. Given
+    user objects are returned as they are and missing users as ``None``.
+    """
+
+    backend = MongoEngineBackend()
+
+    def loader(son):
+        son = backend.get_user_son(son['_id'])
+        if son is None:
+            raise backend.user_class.DoesNotExist("Prefetched user does not exist anymore.")
+        return backend.user_from_son(son)
+
+    ids = []
+    for user in users:
+        if isinstance(user, bson.DBRef):
+            user = user.id
+        elif isinstance(user, basestring):
+            user = bson.ObjectId(user) if bson.ObjectId.is_valid(user) else None
+        ids.append(user)
+
+    query_ids = [user_id for user_id in ids if isinstance(user_id, bson.ObjectId)]
+    views = {}
+    if query_ids:
+        cursor = backend.user_class._get_collection().find({'_id': {'$in': list(set(query_ids))}}, userview.get_prefetch_projection(backend.user_class))
+        views = dict((son['_id'], userview.UserView(backend.user_class, son, loader)) for son in cursor)
+
+    return [views.get(user_id) if isinstance(user_id, bson.ObjectId) else user_id for user_id in ids]
+
+class ProviderBackend(MongoEngineBackend):
+    """
+    Base class for third-party authentication backends.
+    """
+
+    # Name of the provider, used as a prefix of its user fields
+    provider = None
+
+    def link_user(self, request, profile_data, access_token=None):
+        """
+        Finds the user linked with the third-party account, or links the account with
+        the current user. Stores profile data and access token and returns the user.
+
+        Provider fields, changes made by hooks and derived fields are stored with one
+        update of only those fields, so the user does not have to be saved whole and
+        concurrent changes to other fields are not overwritten.
+        """
+
+        uid_key = models.PROVIDER_UID_KEYS[self.provider]
+        profile_data_field = '%s_profile_data' % self.provider
+        uid_field = '%s.%s' % (self.user_class._fields[profile_data_field].db_field, uid_key)
+
+        linked_accounts = getattr(settings, 'LINKED_ACCOUNTS', models.LINKED_ACCOUNTS)
+        access_token_field = '%s_access_token' % self.provider
+
+        fields = {}
+        if linked_accounts:
+            # Full profile data and access token are stored in a linked account
+            stored_profile_data = self.user_class.get_profile_data_summary(self.provider, profile_data)
+            if access_token_field in self.user_class._fields:
+                fields[access_token_field] = None
+        else:
+            stored_profile_data = profile_data
+            if access_token is not None:
+                fields[access_token_field] = access_token
+        fields[profile_data_field] = stored_profile_data
+
+        collection = self.user_class._get_collection()
+
+        for retry in (False, True):
+            son = collection.find_one({uid_field: profile_data[uid_key]})
+            if son is not None:
+                user = self.user_class._from_son(son)
+            elif request.user.pk is None:
+                # A lazy user which has not been saved yet, it is inserted whole
+                user = request.user
+            else:
+                # TODO: Based on user preference, we might create a new user here, not just link with existing, if existing user is lazy user
+                # TODO: Is it OK to override the link if it already exist with some other third-party user?
+                son = collection.find_one({'_id': request.user.pk})
+                if son is None:
+                    return None
+                user = self.user_class._from_son(son)
+
+            try:
+                self.store_user(request, user, fields, profile_data, stored_profile_data)
+                break
+            except (errors.OperationFailure, mongoengine.OperationError), e:
+                if retry or not is_duplicate_key_error(e):
+                    raise
+                # A concurrent request linked the third-party account with some other user meanwhile
+                continue
+
+        if linked_accounts:
+            user.store_linked_account(self.provider, profile_data, access_token)
+
+        return user
+
+    def store_user(self, request, user, fields, profile_data, stored_profile_data):
+        """
+        Sets provider fields on the user, calls the provider's authentication hook and
+        stores only changed fields, together with derived fields, or the whole user if
+        it has not been saved yet.
+        """
+
+        username, lazyuser_username = user.username, user.lazyuser_username
+
+        profile_data_field = '%s_profile_data' % self.provider
+        for name, value in fields.items():
+            setattr(user, name, value)
+
+        # Hooks get full profile data even if only its summary is stored in the user document,
+        # we set it directly so that it is not marked as changed
+        user._data[profile_data_field] = profile_data
+        getattr(user, 'authenticate_%s' % self.provider)(request)
+        user._data[profile_data_field] = stored_profile_data
+
+        try:
+            self.write_user(user)
+        except (errors.OperationFailure, mongoengine.OperationError), e:
+            if not is_duplicate_key_error(e) or user.username == username:
+                raise
+            # Username taken from the third-party account is used by another user, we keep the current one
+            user.username, user.lazyuser_username = username, lazyuser_username
+            self.write_user(user)
+
+    def write_user(self, user):
+        if user.pk is None:
+            user.save()
+            return
+
+        names = dict((field.db_field, name) for name, field in user._fields.items())
+        changed = set(names[key.split('.')[0]] for key in user._get_changed_fields() if key.split('.')[0] in names)
+        user.update_fields(**dict((name, getattr(user, name)) for name in changed))
+
+class FacebookBackend(ProviderBackend):
     """
     Facebook authentication.
     
     Facebook uses strings 'male' and 'female' for representing user gender.
     """
 
+    provider = 'facebook'
+
     # TODO: List all profile data fields we (can) get
 
     def authenticate(self, facebook_access_token, request):
         # Retrieve user's profile information
         # TODO: Handle error, what if request was denied?
-        facebook_profile_data = json.load(urllib.urlopen('https://graph.facebook.com/me?%s' % urllib.urlencode({'access_token': facebook_access_token})))
-
-        try:
-            user = self.user_class.objects.get(facebook_profile_data__id=facebook_profile_data.get('id'))
-        except self.user_class.DoesNotExist:
-            # TODO: Based on user preference, we might create a new user here, not just link with existing, if existing user is lazy user
-            # We reload to make sure user object is recent
-            request.user.reload()
-            user = request.user
-            # TODO: Is it OK to override Facebook link if it already exist with some other Facebook user?
+        facebook_profile_data = circuitbreaker.call(self.provider, transport.get_json, 'https://graph.facebook.com/me', {'access_token': facebook_access_token})
 
-        user.facebook_access_token = facebook_access_token
-        user.facebook_profile_data = facebook_profile_data
-
-        user.authenticate_facebook(request)
-        user.save()
+        if 'id' not in facebook_profile_data:
+            return None
 
-        return user
+        return self.link_user(request, facebook_profile_data, facebook_access_token)
 
-class TwitterBackend(MongoEngineBackend):
+class TwitterBackend(ProviderBackend):
     """
     Twitter authentication.
 
@@ -131,6 +297,8 @@ class TwitterBackend(MongoEngineBackend):
         utc_offset: integer
     """
 
+    provider = 'twitter'
+
     def authenticate(self, twitter_access_token, request):
         TWITTER_CONSUMER_KEY = getattr(settings, 'TWITTER_CONSUMER_KEY', None)
         TWITTER_CONSUMER_SECRET = getattr(settings, 'TWITTER_CONSUMER_SECRET', None)
@@ -142,29 +310,15 @@ class TwitterBackend(MongoEngineBackend):
         twitter_auth.set_access_token(twitter_access_token.key, twitter_access_token.secret)
         twitter_api = tweepy.API(twitter_auth)
 
-        twitter_profile_data = twitter_api.me()
+        twitter_profile_data = circuitbreaker.call(self.provider, twitter_api.me)
 
         if 'id' not in twitter_profile_data:
             return None
 
-        try:
-            user = self.user_class.objects.get(twitter_profile_data__id=twitter_profile_data['id'])
-        except self.user_class.DoesNotExist:
-            # TODO: Based on user preference, we might create a new user here, not just link with existing, if existing user is lazy user
-            # We reload to make sure user object is recent
-            request.user.reload()
-            user = request.user
-            # TODO: Is it OK to override Twitter link if it already exist with some other Twitter user?
+        twitter_access_token = models.TwitterAccessToken(key=twitter_access_token.key, secret=twitter_access_token.secret)
+        return self.link_user(request, twitter_profile_data, twitter_access_token)
 
-        user.twitter_access_token = models.TwitterAccessToken(key=twitter_access_token.key, secret=twitter_access_token.secret)
-        user.twitter_profile_data = twitter_profile_data
-
-        user.authenticate_twitter(request)
-        user.save()
-
-        return user
-
-class GoogleBackend(MongoEngineBackend):
+class GoogleBackend(ProviderBackend):
     """
     Google authentication.
 
@@ -182,32 +336,21 @@ class GoogleBackend(MongoEngineBackend):
         verified_email: True, if email is verified by Google API
     """
 
-    def authenticate(self, google_access_token, request):
-        # Retrieve user's profile information
-        # TODO: Handle error, what if request was denied?
-        google_profile_data = json.load(urllib.urlopen('https://www.googleapis.com/oauth2/v1/userinfo?access_token=%s' % google_access_token))
+    provider = 'google'
+
+    def authenticate(self, google_access_token, request, google_profile_data=None):
+        # Profile data can be already known from a verified ID token
+        if google_profile_data is None:
+            # Retrieve user's profile information
+            # TODO: Handle error, what if request was denied?
+            google_profile_data = circuitbreaker.call(self.provider, transport.get_json, 'https://www.googleapis.com/oauth2/v1/userinfo', {'access_token': google_access_token})
 
         if 'id' not in google_profile_data:
             return None
 
-        try:
-            user = self.user_class.objects.get(google_profile_data__id=google_profile_data['id'])
-        except self.user_class.DoesNotExist:
-            # TODO: Based on user preference, we might create a new user here, not just link with existing, if existing user is lazy user
-            # We reload to make sure user object is recent
-            request.user.reload()
-            user = request.user
-            # TODO: Is it OK to override Google link if it already exist with some other Google user?
-
-        user.google_access_token = google_access_token
-        user.google_profile_data = google_profile_data
+        return self.link_user(request, google_profile_data, google_access_token)
 
-        user.authenticate_google(request)
-        user.save()
-
-        return user
-
-class FoursquareBackend(MongoEngineBackend):
+class FoursquareBackend(ProviderBackend):
     """
     Foursquare authentication.
 
@@ -234,76 +377,49 @@ class FoursquareBackend(MongoEngineBackend):
         pageInfo: contains a detailed page, if they are a page
     """
 
+    provider = 'foursquare'
+
     def authenticate(self, foursquare_access_token, request):
         # Retrieve user's profile information
         # TODO: Handle error, what if request was denied?
-        foursquare_profile_data = json.load(urllib.urlopen('https://api.foursquare.com/v2/users/self?%s' % urllib.urlencode({'oauth_token': foursquare_access_token})))['response']['user']
+        foursquare_profile_data = circuitbreaker.call(self.provider, transport.get_json, 'https://api.foursquare.com/v2/users/self', {'oauth_token': foursquare_access_token})['response']['user']
 
         if 'id' not in foursquare_profile_data:
             return None
 
-        try:
-            user = self.user_class.objects.get(foursquare_profile_data__id=foursquare_profile_data['id'])
-        except self.user_class.DoesNotExist:
-            # TODO: Based on user preference, we might create a new user here, not just link with existing, if existing user is lazy user
-            # We reload to make sure user object is recent
-            request.user.reload()
-            user =  request.user
-            # TODO: Is it OK to override Foursquare link if it already exist with some other Foursquare user?
-
-        user.foursquare_access_token = foursquare_access_token
-        user.foursquare_profile_data = foursquare_profile_data
-
-        user.authenticate_foursquare(request)
-        user.save()
-
-        return user
+        return self.link_user(request, foursquare_profile_data, foursquare_access_token)
 
-class BrowserIDBackend(MongoEngineBackend, browserid_auth.BrowserIDBackend):
+class BrowserIDBackend(ProviderBackend, browserid_auth.BrowserIDBackend):
     """
     Persona authentication.
 
     Persona profile data fields are:
         email: email user uses for Persona
     """
+
+    provider = 'browserid'
     
     def authenticate(self, browserid_assertion=None, browserid_audience=None, request=None):
         browserid_profile_data = browserid_base.verify(browserid_assertion, browserid_audience)
         if not browserid_profile_data or 'email' not in browserid_profile_data:
             return None
 
-        try:
-            user = self.user_class.objects.get(browserid_profile_data__email=browserid_profile_data['email'])
-            # TODO: What is we get more than one user?
-        except self.user_class.DoesNotExist:
-            # TODO: Based on user preference, we might create a new user here, not just link with existing, if existing user is lazy user
-            # We reload to make sure user object is recent
-            request.user.reload()
-            user = request.user
-            # TODO: Is it OK to override BrowserID link if it already exist with some other BrowserID user?
-        
-        user.browserid_profile_data = browserid_profile_data
-
-        user.authenticate_browserid(request)
-        user.save()
+        return self.link_user(request, browserid_profile_data)
 
+class LazyUserBackend(MongoEngineBackend):
+    def build_user(self, request):
+        """
+        Returns a new lazy user which has not yet been saved.
+        """
+
+        # ObjectIds are unique, so lazy usernames never collide and we do not have to retry saving
+        username = LAZYUSER_USERNAME_TEMPLATE % bson.ObjectId()
+        user = self.user_class.create_user(username=username, lazyuser=True, save=False)
+        user.authenticate_lazyuser(request)
         return user
 
-class LazyUserBackend(MongoEngineBackend):
     def authenticate(self, request):
-        while True:
-            try:
-                username = LAZYUSER_USERNAME_TEMPLATE % crypto.get_random_string(6)
-                user = self.user_class.create_user(username=username, lazyuser=True)
-
-                user.authenticate_lazyuser(request)
-                user.save()
-
-                break
-            except queryset.OperationError, e:
-                msg = str(e)
-                if 'E11000' in msg and 'duplicate key error' in msg and 'username' in msg:
-                    continue
-                raise
+        user = self.build_user(request)
+        user.save(force_insert=True)
 
         return user
@@ -0,0 +1,154 @@
+import collections, logging, threading, time
+
+from django.conf import settings
+
+from . import transport
+
+CIRCUIT_BREAKER_WINDOW = 60 # seconds over which calls are counted
+CIRCUIT_BREAKER_MIN_CALLS = 10 # minimal number of calls in the window before the circuit can open
+CIRCUIT_BREAKER_ERROR_RATE = 0.5 # rate of failed calls at which the circuit opens
+CIRCUIT_BREAKER_SLOW_CALL = 5 # seconds after which a successful call is counted as failed
+CIRCUIT_BREAKER_OPEN_TIME = 30 # seconds before a probe call is let through an open circuit
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+logger = logging.getLogger(__name__)
+
+class CircuitOpenError(transport.TransportError):
+    """
+    Raised instead of making a call while the circuit is open.
+    """
+
+class CircuitBreaker(object):
+    """
+    Circuit breaker for calls to a third-party provider.
+
+    It counts failed and slow calls in a sliding window and opens once their
+    rate reaches a threshold. While open, calls fail fast with
+    ``CircuitOpenError``. After a while, one probe call is let through
+    (half-open state): if it succeeds the circuit closes, otherwise it opens again.
+    """
+
+    def __init__(self, name, window, min_calls, error_rate, slow_call, open_time):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.open_time = open_time
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.opened_time = None
+        self.probing = False
+        # Pairs of call time and whether the call failed
+        self.calls = collections.deque()
+        self.counters = collections.defaultdict(int)
+
+    def set_state(self, state):
+        if state != self.state:
+            logger.warning("Circuit breaker for %s changed state from %s to %s", self.name, self.state, state)
+            self.state = state
+            self.counters['transitions_%s' % state.replace('-', '_')] += 1
+        if state == OPEN:
+            self.opened_time = time.time()
+
+    def before_call(self):
+        with self.lock:
+            if self.state == OPEN and time.time() - self.opened_time >= self.open_time:
+                self.set_state(HALF_OPEN)
+
+            if self.state == OPEN or (self.state == HALF_OPEN and self.probing):
+                self.counters['rejected'] += 1
+                raise CircuitOpenError("Circuit breaker for %s is open" % self.name)
+
+            if self.state == HALF_OPEN:
+                self.probing = True
+                return True
+
+            return False
+
+    def after_call(self, probe, failed):
+        now = time.time()
+
+        with self.lock:
+            self.counters['failed' if failed else 'succeeded'] += 1
+
+            if probe:
+                self.probing = False
+                self.calls.clear()
+                self.set_state(OPEN if failed else CLOSED)
+                return
+
+            self.calls.append((now, failed))
+            while self.calls and self.calls[0][0] < now - self.window:
+                self.calls.popleft()
+
+            if self.state == CLOSED and len(self.calls) >= self.min_calls:
+                failures = sum(1 for call_time, call_failed in self.calls if call_failed)
+                if float(failures) / len(self.calls) >= self.error_rate:
+                    self.calls.clear()
+                    self.set_state(OPEN)
+
+    def call(self, func, *args, **kwargs):
+        probe = self.before_call()
+
+        start = time.time()
+        # Interrupted calls (like by gevent.Timeout, which is not an Exception) count as failed,
+        # so that the result is always reported and a probe does not block the circuit forever
+        failed = True
+        try:
+            result = func(*args, **kwargs)
+            failed = time.time() - start >= self.slow_call
+            return result
+        finally:
+            self.after_call(probe, failed)
+
+    def is_open(self):
+        with self.lock:
+            return self.state == OPEN and time.time() - self.opened_time < self.open_time
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats.update({
+                'state': self.state,
+                'opened_time': self.opened_time,
+                'window_calls': len(self.calls),
+                'window_failures': sum(1 for call_time, call_failed in self.calls if call_failed),
+            })
+        return stats
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(provider):
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(
+                provider,
+                getattr(settings, 'CIRCUIT_BREAKER_WINDOW', CIRCUIT_BREAKER_WINDOW),
+                getattr(settings, 'CIRCUIT_BREAKER_MIN_CALLS', CIRCUIT_BREAKER_MIN_CALLS),
+                getattr(settings, 'CIRCUIT_BREAKER_ERROR_RATE', CIRCUIT_BREAKER_ERROR_RATE),
+                getattr(settings, 'CIRCUIT_BREAKER_SLOW_CALL', CIRCUIT_BREAKER_SLOW_CALL),
+                getattr(settings, 'CIRCUIT_BREAKER_OPEN_TIME', CIRCUIT_BREAKER_OPEN_TIME),
+            )
+        return _breakers[provider]
+
+def call(provider, func, *args, **kwargs):
+    """
+    Calls ``func`` with given arguments through the circuit breaker of the given provider.
+    """
+
+    return get_breaker(provider).call(func, *args, **kwargs)
+
+def get_stats():
+    """
+    Returns states and counters of circuit breakers in this process, by provider.
+    """
+
+    with _breakers_lock:
+        breakers = _breakers.items()
+    return dict((provider, breaker.get_stats()) for provider, breaker in breakers)
@@ -1,5 +1,7 @@
 from django import template
 
+from ... import backends
+
 register = template.Library()
 
 @register.inclusion_tag('mongo_auth/user_image.html', takes_context=True)
@@ -13,3 +15,13 @@ def user_image(context, user=None):
     return {
         'user_image_url': user.get_image_url(),
     }
+
+@register.inclusion_tag('mongo_auth/user_images.html')
+def user_images(users):
+    """
+    Renders images of a list of users, user ids or references, loading all of them with one query.
+    """
+
+    return {
+        'user_image_urls': [user.get_image_url() for user in backends.prefetch_users(users or []) if user is not None],
+    }
@@ -25,10 +25,7 @@ def set_language(request):
     if request.method == 'POST':
         lang_code = request.POST.get('language', None)
         if lang_code and translation.check_for_language(lang_code):
-            # We reload to make sure user object is recent
-            request.user.reload()
-            request.user.language = lang_code
-            request.user.save()
+            request.user.update_fields(language=lang_code)
     return response
 
 class RegistrationView(views.RegistrationView):
@@ -45,11 +42,13 @@ class RegistrationView(views.RegistrationView):
 class AccountChangeView(views.AccountChangeView):
     form_class = forms.AccountChangeForm
 
-    def form_valid(self, form):
-        user = self.request.user
-        user.gender = form.cleaned_data['gender']
-        user.birthdate = form.cleaned_data['birthdate']
-        return super(AccountChangeView, self).form_valid(form)
+    def account_data(self, form):
+        data = super(AccountChangeView, self).account_data(form)
+        data.update({
+            'gender': form.cleaned_data['gender'],
+            'birthdate': form.cleaned_data['birthdate'],
+        })
+        return data
 
     def get_initial(self):
         initial = super(AccountChangeView, self).get_initial()
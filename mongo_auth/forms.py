@@ -1,18 +1,32 @@
-import sys
-
 from django import forms
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth import forms as auth_forms, hashers, tokens
 from django.contrib.sites import models as sites_models
 from django.template import loader
-from django.utils import http
 from django.utils.translation import ugettext_lazy as _
 
 import bson
 
+import mongoengine
+
 from . import backends, models
 
+class AuthenticationForm(auth_forms.AuthenticationForm):
+    """
+    Authentication form which rejects login attempts throttled by the login view,
+    without authenticating them.
+    """
+
+    def __init__(self, request=None, throttled=False, *args, **kwargs):
+        super(AuthenticationForm, self).__init__(request, *args, **kwargs)
+        self.throttled = throttled
+
+    def clean(self):
+        if self.throttled:
+            raise forms.ValidationError(_("Too many login attempts. Please try again later."), code='throttled')
+        return super(AuthenticationForm, self).clean()
+
 class UserUsernameForm(forms.Form):
     """
     Class with username form.
@@ -35,7 +49,7 @@ class UserUsernameForm(forms.Form):
         """
 
         username = self.cleaned_data['username']
-        if backends.User.objects(username__iexact=username).count():
+        if backends.User.objects(backends.User.username_query(username)).count():
             raise forms.ValidationError(_("A user with that username already exists."), code='username_exists')
         return username
 
@@ -147,30 +161,53 @@ class EmailConfirmationProcessTokenForm(forms.Form):
             raise forms.ValidationError(_("The confirmation token is invalid or has expired. Please retry."), code='confirmation_token_incorrect')
         return confirmation_token
 
-def objectid_to_base36(i):
-    assert isinstance(i, bson.ObjectId), type(i)
-    old_maxint = sys.maxint
-    sys.maxint = old_maxint**2
-    try:
-        return http.int_to_base36(int(str(i), 16))
-    finally:
-        sys.maxint = old_maxint
+BASE36_DIGITS = '0123456789abcdefghijklmnopqrstuvwxyz'
+# ObjectIds are 96 bits long, which is at most 19 base36 digits
+OBJECTID_BASE36_MAX_LENGTH = 19
+
+def objectid_to_base36(objectid):
+    assert isinstance(objectid, bson.ObjectId), type(objectid)
+    i = int(str(objectid), 16)
+    digits = []
+    while True:
+        i, digit = divmod(i, 36)
+        digits.append(BASE36_DIGITS[digit])
+        if i == 0:
+            break
+    return ''.join(reversed(digits))
+
+def base36_to_objectid(s):
+    """
+    Converts a base36 string back to an ObjectId, raising ``ValueError`` if it is invalid.
+    """
+
+    if len(s) > OBJECTID_BASE36_MAX_LENGTH:
+        raise ValueError("Base36 string too long for an ObjectId: %s" % s)
+    # int would also accept a sign, whitespace and uppercase digits
+    if not s or s.strip(BASE36_DIGITS):
+        raise ValueError("Invalid base36 string: %s" % s)
+    i = int(s, 36)
+    if i >= 2**96:
+        raise ValueError("Base36 string too large for an ObjectId: %s" % s)
+    return bson.ObjectId('%024x' % i)
 
 class PasswordResetForm(auth_forms.PasswordResetForm):
     def clean_email(self):
         email = self.cleaned_data["email"]
-        self.users_cache = backends.User.objects.filter(email__iexact=email, is_active=True)
-        if not len(self.users_cache):
+        query = backends.User.email_query(email) & mongoengine.Q(is_active=True)
+        # We fetch only passwords here, whole users are fetched in save
+        passwords = [user.password for user in backends.User.objects(query).only('password')]
+        if not passwords:
             raise forms.ValidationError(self.error_messages['unknown'])
         # We use "all" instead of "any" and skip all users with unusable passwords in save
-        if all((user.password == hashers.UNUSABLE_PASSWORD) for user in self.users_cache):
+        if all((password == hashers.UNUSABLE_PASSWORD) for password in passwords):
             raise forms.ValidationError(self.error_messages['unusable'])
+        # A new queryset, as older versions of MongoEngine modify querysets in place instead of cloning them
+        self.users_cache = backends.User.objects(query & mongoengine.Q(password__ne=hashers.UNUSABLE_PASSWORD))
         return email
 
     def save(self, domain_override=None, subject_template_name='mongo_auth/password_reset_subject.txt', email_template_name='mongo_auth/password_reset_email.html', use_https=False, token_generator=tokens.default_token_generator, from_email=None, request=None):
         for user in self.users_cache:
-            if user.password == hashers.UNUSABLE_PASSWORD:
-                continue
             if not domain_override:
                 current_site = sites_models.get_current_site(request)
                 site_name = current_site.name
@@ -0,0 +1,141 @@
+import json, logging, threading, time
+
+from django.conf import settings
+from django.core import exceptions
+
+try:
+    import jwt
+    from jwt import algorithms as jwt_algorithms
+except ImportError:
+    jwt = None
+
+from . import circuitbreaker, transport
+
+# Take Google profile data from the ID token instead of calling the userinfo endpoint
+GOOGLE_VERIFY_ID_TOKEN = False
+GOOGLE_CERTS_URL = 'https://www.googleapis.com/oauth2/v3/certs'
+GOOGLE_CERTS_REFRESH = 60 * 60 # seconds
+GOOGLE_ISSUERS = ('accounts.google.com', 'https://accounts.google.com')
+# Unknown key ids trigger a refresh (keys are rotated), but at most this often
+KEY_SET_MIN_REFRESH = 60 # seconds
+
+# Maps ID token claims to keys of Google profile data as returned by the userinfo endpoint
+GOOGLE_PROFILE_DATA_CLAIMS = (
+    ('sub', 'id'),
+    ('email', 'email'),
+    ('email_verified', 'verified_email'),
+    ('name', 'name'),
+    ('given_name', 'given_name'),
+    ('family_name', 'family_name'),
+    ('picture', 'picture'),
+    ('locale', 'locale'),
+)
+
+logger = logging.getLogger(__name__)
+
+class InvalidIdToken(Exception):
+    """
+    Raised when an ID token cannot be verified.
+    """
+
+class KeySet(object):
+    """
+    Set of signing keys published in JWK format at the given URL, cached
+    and periodically refreshed.
+    """
+
+    def __init__(self, url, provider, refresh):
+        self.url = url
+        self.provider = provider
+        self.refresh = refresh
+        self.keys = {}
+        self.fetched_time = None
+        self.lock = threading.Lock()
+
+    def set_keys(self, jwks):
+        """
+        Sets keys from a JWK set, for example one generated locally in tests.
+        Raises ``InvalidIdToken`` if the set cannot be parsed.
+        """
+
+        try:
+            keys = dict((jwk['kid'], jwt_algorithms.RSAAlgorithm.from_jwk(json.dumps(jwk))) for jwk in jwks['keys'])
+        except (KeyError, TypeError, ValueError, jwt.InvalidKeyError), e:
+            raise InvalidIdToken("Invalid key set: %r" % e)
+        with self.lock:
+            self.keys = keys
+            self.fetched_time = time.time()
+
+    def fetch(self):
+        self.set_keys(circuitbreaker.call(self.provider, transport.get_json, self.url))
+
+    def get_key(self, kid):
+        with self.lock:
+            age = None if self.fetched_time is None else time.time() - self.fetched_time
+            key = self.keys.get(kid)
+
+        if age is None or age >= self.refresh or (key is None and age >= KEY_SET_MIN_REFRESH):
+            self.fetch()
+            with self.lock:
+                key = self.keys.get(kid)
+
+        if key is None:
+            raise InvalidIdToken("Unknown key id: %s" % kid)
+        return key
+
+_google_key_set = None
+
+def get_google_key_set():
+    global _google_key_set
+
+    if _google_key_set is None:
+        _google_key_set = KeySet(GOOGLE_CERTS_URL, 'google', getattr(settings, 'GOOGLE_CERTS_REFRESH', GOOGLE_CERTS_REFRESH))
+    return _google_key_set
+
+def verify_google_id_token(id_token, key_set=None):
+    """
+    Verifies signature, audience, issuer and expiration of a Google ID token
+    and returns its claims.
+    """
+
+    if jwt is None:
+        raise exceptions.ImproperlyConfigured("Verifying ID tokens requires PyJWT and cryptography to be installed.")
+
+    if key_set is None:
+        key_set = get_google_key_set()
+
+    try:
+        kid = jwt.get_unverified_header(id_token).get('kid')
+        claims = jwt.decode(id_token, key_set.get_key(kid), algorithms=['RS256'], audience=settings.GOOGLE_CLIENT_ID)
+    except jwt.InvalidTokenError, e:
+        raise InvalidIdToken(str(e))
+
+    if claims.get('iss') not in GOOGLE_ISSUERS:
+        raise InvalidIdToken("Invalid issuer: %s" % claims.get('iss'))
+
+    return claims
+
+def get_google_profile_data(token_response, key_set=None):
+    """
+    Returns Google profile data from the ID token in the token endpoint response,
+    or ``None`` if it is not enabled, not available or could not be verified.
+    """
+
+    if not getattr(settings, 'GOOGLE_VERIFY_ID_TOKEN', GOOGLE_VERIFY_ID_TOKEN) or 'id_token' not in token_response:
+        return None
+
+    try:
+        claims = verify_google_id_token(token_response['id_token'], key_set)
+    except InvalidIdToken, e:
+        logger.warning("Google ID token could not be verified: %s", e)
+        return None
+    except transport.TransportError, e:
+        # Includes open circuit for the provider
+        logger.warning("Google ID token signing keys could not be fetched: %s", e)
+        return None
+
+    profile_data = dict((key, claims[claim]) for claim, key in GOOGLE_PROFILE_DATA_CLAIMS if claim in claims)
+    if 'verified_email' in profile_data:
+        # Some ID tokens contain it as a string
+        profile_data['verified_email'] = profile_data['verified_email'] in (True, 'true')
+    return profile_data
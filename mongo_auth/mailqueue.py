@@ -0,0 +1,114 @@
+import datetime, logging
+
+from django.conf import settings
+from django.core import mail
+from django.utils import timezone
+
+from . import models
+
+EMAIL_QUEUE_BATCH_SIZE = 50
+EMAIL_QUEUE_MAX_ATTEMPTS = 5
+# Delay before the first retry, doubled on each further retry
+EMAIL_QUEUE_RETRY_DELAY = 60 # seconds
+# For how long a message being sent is not given to other workers
+EMAIL_QUEUE_LEASE = 5 * 60 # seconds
+
+logger = logging.getLogger(__name__)
+
+def claim(now):
+    """
+    Atomically claims the oldest message due for sending, or returns ``None``.
+    """
+
+    collection = models.QueuedEmail._get_collection()
+    lease = getattr(settings, 'EMAIL_QUEUE_LEASE', EMAIL_QUEUE_LEASE)
+    son = collection.find_and_modify(
+        {'failed': False, 'next_attempt_time': {'$lte': now}},
+        {'$set': {'next_attempt_time': now + datetime.timedelta(seconds=lease)}, '$inc': {'attempts': 1}},
+        sort=[('next_attempt_time', 1)],
+        new=True,
+    )
+    if son is None:
+        return None
+    return models.QueuedEmail._from_son(son)
+
+def claim_batch(size):
+    now = timezone.now()
+    batch = []
+    while len(batch) < size:
+        email = claim(now)
+        if email is None:
+            break
+        batch.append(email)
+    return batch
+
+def retry_later(email, error):
+    """
+    Schedules the message for another attempt with exponential backoff, or marks
+    it as failed when it has run out of attempts.
+    """
+
+    collection = models.QueuedEmail._get_collection()
+    max_attempts = getattr(settings, 'EMAIL_QUEUE_MAX_ATTEMPTS', EMAIL_QUEUE_MAX_ATTEMPTS)
+    delay = getattr(settings, 'EMAIL_QUEUE_RETRY_DELAY', EMAIL_QUEUE_RETRY_DELAY) * 2 ** (email.attempts - 1)
+
+    update = {'last_error': unicode(error)}
+    if email.attempts >= max_attempts:
+        logger.error("Sending e-mail %s to %s failed after %d attempts: %s", email.pk, ', '.join(email.to), email.attempts, error)
+        update['failed'] = True
+    else:
+        update['next_attempt_time'] = timezone.now() + datetime.timedelta(seconds=delay)
+    collection.update({'_id': email.pk}, {'$set': update}, safe=True)
+
+def send_batch(size=None):
+    """
+    Sends a batch of due messages over one SMTP connection. Returns numbers
+    of sent messages and of messages which have to be retried or have failed.
+    """
+
+    if size is None:
+        size = getattr(settings, 'EMAIL_QUEUE_BATCH_SIZE', EMAIL_QUEUE_BATCH_SIZE)
+
+    batch = claim_batch(size)
+    if not batch:
+        return 0, 0
+
+    connection = mail.get_connection()
+    try:
+        connection.open()
+    except Exception, e:
+        for email in batch:
+            retry_later(email, e)
+        return 0, len(batch)
+
+    sent = []
+    failed = 0
+    try:
+        for email in batch:
+            # Messages are sent one by one over the open connection, so that
+            # a failure of one does not prevent or repeat others
+            try:
+                connection.send_messages([email.get_message(connection)])
+            except Exception, e:
+                retry_later(email, e)
+                failed += 1
+            else:
+                sent.append(email.pk)
+    finally:
+        connection.close()
+        if sent:
+            models.QueuedEmail._get_collection().remove({'_id': {'$in': sent}}, safe=True)
+
+    return len(sent), failed
+
+def get_queue_depth():
+    """
+    Returns numbers of queued messages: all pending, those due for sending, and failed.
+    """
+
+    collection = models.QueuedEmail._get_collection()
+    return {
+        'pending': collection.find({'failed': False}).count(),
+        'due': collection.find({'failed': False, 'next_attempt_time': {'$lte': timezone.now()}}).count(),
+        'failed': collection.find({'failed': True}).count(),
+    }
@@ -0,0 +1,81 @@
+import time
+from optparse import make_option
+
+from django.core.management import base
+
+import bson
+from pymongo import errors
+
+from ... import backends
+
+class Command(base.BaseCommand):
+    """
+    Computes and stores derived fields (like normalized username) of existing users.
+
+    Users are processed in batches in the order of their ids, so the command can be run
+    against a live database and, if interrupted, resumed with ``--start-after``.
+    """
+
+    help = "Backfills derived user fields (like normalized username) of existing users."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=1000,
+            help="Number of users processed in one batch. Default is 1000."),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=0,
+            help="Seconds to sleep between batches to limit load on the database. Default is 0."),
+        make_option('--start-after', action='store', type='string', dest='start_after', default=None,
+            help="Resume after the user with the given id, as reported by a previous run."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        collection = backends.User._get_collection()
+
+        query = {}
+        if options['start_after']:
+            query['_id'] = {'$gt': bson.ObjectId(options['start_after'])}
+
+        processed = updated = conflicts = 0
+        while True:
+            batch = list(collection.find(query).sort('_id', 1).limit(options['batch_size']))
+            if not batch:
+                break
+
+            for son in batch:
+                user = backends.User._from_son(son)
+                updates, removals = {}, {}
+                for name, value in user.get_derived_fields().items():
+                    field = user._fields[name]
+                    if value is None:
+                        if field.db_field in son:
+                            removals[field.db_field] = 1
+                    else:
+                        value = field.to_mongo(value)
+                        if son.get(field.db_field) != value:
+                            updates[field.db_field] = value
+
+                if updates or removals:
+                    document = {}
+                    if updates:
+                        document['$set'] = updates
+                    if removals:
+                        document['$unset'] = removals
+                    try:
+                        collection.update({'_id': son['_id']}, document, safe=True)
+                        updated += 1
+                    except errors.DuplicateKeyError, e:
+                        # For example, two usernames differing only in case, which has to be resolved manually
+                        conflicts += 1
+                        self.stderr.write("Conflict for user %s: %s\n" % (son['_id'], e))
+
+            processed += len(batch)
+            query['_id'] = {'$gt': batch[-1]['_id']}
+
+            if verbosity > 1:
+                self.stdout.write("Processed %d users, last id %s\n" % (processed, batch[-1]['_id']))
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if verbosity > 0:
+            self.stdout.write("Processed %d users, updated %d, conflicts %d.\n" % (processed, updated, conflicts))
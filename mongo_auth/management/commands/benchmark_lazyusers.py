@@ -0,0 +1,88 @@
+import timeit
+from optparse import make_option
+
+from django.core.management import base
+from django.test import client
+
+import bson
+import mongoengine
+
+from ... import backends
+
+class Command(base.BaseCommand):
+    """
+    Measures insert throughput of lazy users on a collection which already contains the
+    given number of lazy users, inserting missing ones first in batches.
+
+    Inserted users are not distinguishable from real lazy users, so run it against a
+    benchmark database, or use ``--cleanup`` to delete users inserted by the command.
+    """
+
+    help = "Benchmarks creating lazy users with many existing lazy users."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--existing', action='store', type='int', dest='existing', default=10000000,
+            help="Number of existing lazy users to benchmark with. Default is 10000000."),
+        make_option('--count', action='store', type='int', dest='count', default=10000,
+            help="Number of lazy users created in the benchmark. Default is 10000."),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=1000,
+            help="Number of existing lazy users inserted in one batch. Default is 1000."),
+        make_option('--cleanup', action='store_true', dest='cleanup', default=False,
+            help="Delete all lazy users inserted by the command afterwards."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        collection = backends.User._get_collection()
+        backend = backends.LazyUserBackend()
+        request = client.RequestFactory().get('/')
+
+        # Everything the command inserts has a larger ObjectId
+        first_id = bson.ObjectId()
+
+        lazyuser_query = backends.User.objects(lazyuser_username=True)._query
+        existing = collection.find(lazyuser_query).count()
+        if existing < options['existing']:
+            self.fill(collection, backend, request, options['existing'] - existing, options['batch_size'], verbosity)
+
+        collisions = []
+
+        def create():
+            try:
+                backend.authenticate(request)
+            except mongoengine.OperationError, e:
+                if not backends.is_duplicate_key_error(e):
+                    raise
+                collisions.append(e)
+
+        count = options['count']
+        seconds = timeit.timeit(create, number=count)
+        self.stdout.write("Created %d lazy users with %d existing: %.1f users per second, %.1f us per user, %d collisions.\n" % (count, max(existing, options['existing']), count / seconds, seconds / count * 1e6, len(collisions)))
+
+        if options['cleanup']:
+            collection.remove(dict(lazyuser_query, _id={'$gte': first_id}), safe=True)
+            if verbosity > 0:
+                self.stdout.write("Deleted lazy users inserted by the benchmark.\n")
+
+    def fill(self, collection, backend, request, missing, batch_size, verbosity):
+        # We build one lazy user document and copy it, building each one would dominate the time
+        user = backend.build_user(request)
+        for name, value in user.get_derived_fields().items():
+            setattr(user, name, value)
+        template = user.to_mongo()
+        username_field = backends.User._fields['username'].db_field
+        username_lower_field = backends.User._fields['username_lower'].db_field
+
+        inserted = 0
+        while inserted < missing:
+            batch = []
+            for i in range(min(batch_size, missing - inserted)):
+                objectid = bson.ObjectId()
+                son = dict(template, _id=objectid)
+                son[username_field] = son[username_lower_field] = backends.LAZYUSER_USERNAME_TEMPLATE % objectid
+                batch.append(son)
+            collection.insert(batch, safe=True)
+            inserted += len(batch)
+
+            if verbosity > 1:
+                self.stdout.write("Inserted %d existing lazy users so far.\n" % inserted)
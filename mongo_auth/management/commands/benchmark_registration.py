@@ -0,0 +1,65 @@
+import timeit
+from optparse import make_option
+
+from django.contrib.auth import hashers
+from django.core.management import base
+
+import bson
+
+from ... import backends
+
+class Command(base.BaseCommand):
+    """
+    Compares registrations per second of the previous registration flow (case-insensitive
+    regex existence check, hashing and saving the password, saving the user again and
+    authenticating it, which queries the user and verifies the password again) and the
+    current one (indexed existence check, one hash and one insert).
+
+    Created users are deleted afterwards.
+    """
+
+    help = "Benchmarks registration of new users."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--count', action='store', type='int', dest='count', default=100,
+            help="Number of users registered with each flow. Default is 100."),
+    )
+
+    def handle(self, *args, **options):
+        User = backends.User
+        password = 'benchmark-password'
+        created = []
+
+        def new_user():
+            # Username fits the 30 characters limit
+            user = User(username='bench%s' % bson.ObjectId(), first_name="Bench", last_name="Mark", email='bench@example.com')
+            created.append(user)
+            return user
+
+        def previous():
+            user = new_user()
+            if User.objects(username__iexact=user.username).count():
+                raise base.CommandError("Username collision.")
+            # set_password used to hash the password and save the user, which was then saved again
+            user.password = hashers.make_password(password)
+            user.save()
+            user.save()
+            # Authentication to attach a backend, with the same regex query and password verification
+            authenticated = User.objects(username__iexact=user.username).first()
+            if authenticated is None or not authenticated.check_password(password):
+                raise base.CommandError("Authentication failed.")
+
+        def current():
+            user = new_user()
+            if User.objects(User.username_query(user.username)).count():
+                raise base.CommandError("Username collision.")
+            user.password = hashers.make_password(password)
+            user.save(force_insert=True)
+
+        count = options['count']
+        try:
+            for name, func in (('Previous', previous), ('Current', current)):
+                seconds = timeit.timeit(func, number=count)
+                self.stdout.write("%s: %.1f registrations per second, %.1f ms per registration.\n" % (name, count / seconds, seconds / count * 1e3))
+        finally:
+            User.objects(pk__in=[user.pk for user in created if user.pk is not None]).delete()
@@ -0,0 +1,48 @@
+import timeit
+from optparse import make_option
+
+from django.core.management import base
+
+from ... import backends, userview
+
+class Command(base.BaseCommand):
+    """
+    Compares the cost of producing the per-request user from a raw user document as
+    the user object and as a user view, and of reading what a typical page reads from it.
+    """
+
+    help = "Benchmarks constructing user objects against user views."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--user', action='store', type='string', dest='username', default=None,
+            help="Username of the user to benchmark with. Default is any user."),
+        make_option('--iterations', action='store', type='int', dest='iterations', default=10000,
+            help="Number of iterations. Default is 10000."),
+    )
+
+    def handle(self, *args, **options):
+        collection = backends.User._get_collection()
+        if options['username']:
+            son = collection.find_one(backends.User.objects(backends.User.username_query(options['username']))._query)
+        else:
+            son = collection.find_one()
+        if son is None:
+            raise base.CommandError("No user found.")
+
+        backend = backends.MongoEngineBackend()
+
+        def use(user):
+            user.is_authenticated()
+            user.username
+            user.get_image_url()
+
+        def document():
+            use(backend.user_from_son(son))
+
+        def view():
+            use(userview.UserView(backend.user_class, son, backend.user_from_son))
+
+        iterations = options['iterations']
+        for name, func in (('User document', document), ('User view', view)):
+            seconds = timeit.timeit(func, number=iterations)
+            self.stdout.write("%s: %.1f us per request user.\n" % (name, seconds / iterations * 1e6))
@@ -0,0 +1,95 @@
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management import base
+from django.utils import timezone
+
+import bson
+
+from ... import backends, models
+
+class Command(base.BaseCommand):
+    """
+    Moves third-party profile data and access tokens of existing users into linked accounts.
+
+    Users are processed in batches in the order of their ids. Users whose profile data
+    has already been reduced to a summary are skipped, so the command can be safely rerun.
+    """
+
+    help = "Moves third-party profile data and access tokens of existing users into linked accounts."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=1000,
+            help="Number of users processed in one batch. Default is 1000."),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=0,
+            help="Seconds to sleep between batches to limit load on the database. Default is 0."),
+        make_option('--start-after', action='store', type='string', dest='start_after', default=None,
+            help="Resume after the user with the given id, as reported by a previous run."),
+    )
+
+    def handle(self, *args, **options):
+        if not getattr(settings, 'LINKED_ACCOUNTS', models.LINKED_ACCOUNTS):
+            # Otherwise profile data and access tokens are still read from user documents and would be lost
+            raise base.CommandError("LINKED_ACCOUNTS setting has to be enabled before migrating users.")
+
+        verbosity = int(options['verbosity'])
+        users = backends.User._get_collection()
+        linked_accounts = models.LinkedAccount._get_collection()
+
+        for provider, uid_key in sorted(models.PROVIDER_UID_KEYS.items()):
+            profile_data_field = backends.User._fields['%s_profile_data' % provider]
+            access_token_field = backends.User._fields.get('%s_access_token' % provider)
+            summary_keys = models.PROFILE_DATA_SUMMARY_KEYS[profile_data_field.name]
+
+            # Linked users are found through the sparse index on their third-party identity
+            query = {'%s.%s' % (profile_data_field.db_field, uid_key): {'$exists': True}}
+            if options['start_after']:
+                query['_id'] = {'$gt': bson.ObjectId(options['start_after'])}
+
+            projection = [profile_data_field.db_field]
+            if access_token_field:
+                projection.append(access_token_field.db_field)
+
+            processed = migrated = 0
+            while True:
+                batch = list(users.find(query, projection).sort('_id', 1).limit(options['batch_size']))
+                if not batch:
+                    break
+
+                for son in batch:
+                    profile_data = son[profile_data_field.db_field]
+                    access_token = son.get(access_token_field.db_field) if access_token_field else None
+                    if set(profile_data) <= set(summary_keys) and access_token is None:
+                        continue
+
+                    access_token_secret = None
+                    if isinstance(access_token, dict):
+                        # Twitter access token is an embedded document
+                        access_token, access_token_secret = access_token.get('key'), access_token.get('secret')
+
+                    linked_accounts.update({'provider': provider, 'uid': unicode(profile_data[uid_key])}, {'$set': {
+                        'user_id': son['_id'],
+                        'access_token': access_token,
+                        'access_token_secret': access_token_secret,
+                        'profile_data': profile_data,
+                        'updated_time': timezone.now(),
+                    }}, upsert=True, safe=True)
+
+                    document = {'$set': {profile_data_field.db_field: dict((key, profile_data[key]) for key in summary_keys if key in profile_data)}}
+                    if access_token_field:
+                        document['$unset'] = {access_token_field.db_field: 1}
+                    users.update({'_id': son['_id']}, document, safe=True)
+                    migrated += 1
+
+                processed += len(batch)
+                query['_id'] = {'$gt': batch[-1]['_id']}
+
+                if verbosity > 1:
+                    self.stdout.write("%s: processed %d users, last id %s\n" % (provider, processed, batch[-1]['_id']))
+
+                if options['sleep']:
+                    time.sleep(options['sleep'])
+
+            if verbosity > 0:
+                self.stdout.write("%s: processed %d users, migrated %d.\n" % (provider, processed, migrated))
@@ -0,0 +1,111 @@
+import datetime, time
+from optparse import make_option
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.core.management import base
+from django.utils import timezone
+
+import bson
+
+from ... import backends, models
+
+# Lazy users without activity for longer than this are considered abandoned
+LAZYUSER_MAX_AGE = 30 # days
+
+class Command(base.BaseCommand):
+    """
+    Deletes abandoned lazy users: users with a lazy username, without a usable password
+    and third-party accounts, without activity for longer than the given age. Activity of
+    lazy users is recorded by ``LazyUserMiddleware`` in their last login time.
+
+    Users are deleted in batches, optionally waiting for replication of each batch and
+    sleeping between batches, so that the command can run against a live primary.
+
+    Alternatively, the command can create a TTL index on ``lazyuser_last_login`` field,
+    which makes MongoDB itself expire abandoned lazy users.
+    """
+
+    help = "Deletes abandoned lazy users, or manages a TTL index which expires them."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--age', action='store', type='int', dest='age', default=None,
+            help="Age in days after which lazy users without activity are deleted. Default is LAZYUSER_MAX_AGE setting or 30."),
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=500,
+            help="Number of users deleted in one batch. Default is 500."),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=1,
+            help="Seconds to sleep between batches. Default is 1."),
+        make_option('--replicas', action='store', type='int', dest='replicas', default=None,
+            help="Wait for each batch to replicate to the given number of servers."),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+            help="Only report how many users would be deleted."),
+        make_option('--ensure-ttl-index', action='store_true', dest='ensure_ttl_index', default=False,
+            help="Instead of deleting, create a TTL index which expires abandoned lazy users after the given age."),
+        make_option('--drop-ttl-index', action='store_true', dest='drop_ttl_index', default=False,
+            help="Instead of deleting, drop the TTL index."),
+    )
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+        collection = backends.User._get_collection()
+
+        age = options['age']
+        if age is None:
+            age = getattr(settings, 'LAZYUSER_MAX_AGE', LAZYUSER_MAX_AGE)
+
+        db_field = backends.User._fields['lazyuser_last_login'].db_field
+
+        if options['ensure_ttl_index']:
+            # Field is set only for lazy users, so other users never expire
+            collection.ensure_index(db_field, expireAfterSeconds=age * 24 * 60 * 60)
+            if verbosity > 0:
+                self.stdout.write("TTL index on %s ensured, expiring after %d days.\n" % (db_field, age))
+            return
+
+        if options['drop_ttl_index']:
+            collection.drop_index([(db_field, 1)])
+            if verbosity > 0:
+                self.stdout.write("TTL index on %s dropped.\n" % db_field)
+            return
+
+        conditions = {
+            'lazyuser_username': True,
+            'last_login__lt': timezone.now() - datetime.timedelta(days=age),
+            'password__in': [hashers.UNUSABLE_PASSWORD, None],
+        }
+        for provider, uid_key in models.PROVIDER_UID_KEYS.items():
+            conditions['%s_profile_data__%s__exists' % (provider, uid_key)] = False
+        query = backends.User.objects(**conditions)._query
+
+        if options['dry_run']:
+            self.stdout.write("%d abandoned lazy users would be deleted.\n" % collection.find(query).count())
+            return
+
+        write_options = {'safe': True}
+        if options['replicas']:
+            write_options['w'] = options['replicas']
+
+        deleted = reclaimed = 0
+        while True:
+            batch = list(collection.find(query).limit(options['batch_size']))
+            if not batch:
+                break
+
+            ids = [son['_id'] for son in batch]
+            # We repeat the query, so that users which became active in the meantime are not deleted
+            result = collection.remove(dict(query, _id={'$in': ids}), **write_options)
+            deleted += result.get('n', 0)
+            if result.get('n', 0) < len(batch):
+                # Some users have not been deleted, we count only those which have been
+                remaining = set(son['_id'] for son in collection.find({'_id': {'$in': ids}}, ['_id']))
+                batch = [son for son in batch if son['_id'] not in remaining]
+            reclaimed += sum(len(bson.BSON.encode(son)) for son in batch)
+
+            if verbosity > 1:
+                self.stdout.write("Deleted %d users so far.\n" % deleted)
+
+            if options['sleep']:
+                time.sleep(options['sleep'])
+
+        if verbosity > 0:
+            self.stdout.write("Deleted %d abandoned lazy users, reclaiming about %d bytes.\n" % (deleted, reclaimed))
@@ -0,0 +1,59 @@
+import time
+from optparse import make_option
+
+from django.core.management import base
+
+from ... import mailqueue
+
+class Command(base.BaseCommand):
+    """
+    Sends e-mails from the outbound queue in batches, each over one SMTP connection.
+
+    Messages which fail to send are retried with exponential backoff and marked as
+    failed after ``EMAIL_QUEUE_MAX_ATTEMPTS`` attempts. Multiple workers can run at
+    the same time, each message is claimed by only one of them.
+    """
+
+    help = "Sends queued e-mails."
+
+    option_list = base.BaseCommand.option_list + (
+        make_option('--batch-size', action='store', type='int', dest='batch_size', default=None,
+            help="Number of messages sent over one connection. Default is EMAIL_QUEUE_BATCH_SIZE setting or 50."),
+        make_option('--loop', action='store_true', dest='loop', default=False,
+            help="Keep polling the queue instead of exiting once it is drained."),
+        make_option('--sleep', action='store', type='float', dest='sleep', default=5,
+            help="Seconds to sleep when the queue is drained, when polling. Default is 5."),
+        make_option('--status', action='store_true', dest='status', default=False,
+            help="Only report queue depth."),
+    )
+
+    def report_depth(self):
+        depth = mailqueue.get_queue_depth()
+        self.stdout.write("Queue has %(pending)d pending messages, %(due)d due for sending, and %(failed)d failed messages.\n" % depth)
+
+    def handle(self, *args, **options):
+        verbosity = int(options['verbosity'])
+
+        if options['status']:
+            self.report_depth()
+            return
+
+        total_sent = total_failed = 0
+        while True:
+            sent, failed = mailqueue.send_batch(options['batch_size'])
+            total_sent += sent
+            total_failed += failed
+
+            if verbosity > 1 and (sent or failed):
+                self.stdout.write("Sent %d messages, %d failed.\n" % (sent, failed))
+
+            if sent or failed:
+                continue
+            if not options['loop']:
+                break
+
+            time.sleep(options['sleep'])
+
+        if verbosity > 0:
+            self.stdout.write("Sent %d messages, %d failed.\n" % (total_sent, total_failed))
+            self.report_depth()
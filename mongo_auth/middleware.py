@@ -1,12 +1,34 @@
+import time
+
+from django.conf import settings
 from django.contrib import auth
 from django.contrib.auth import models as auth_models
+from django.utils import timezone
+
+from . import backends, snapshot, userview
+
+# Save lazy users only once something saves them, instead of for every new session
+LAZYUSER_DEFERRED_SAVE = False
+# Last login time of lazy users is updated on a request at most this often, so that abandoned lazy users
+# can be told apart from active ones (lazy users log in only once), 0 disables it
+LAZYUSER_ACTIVITY_GRANULARITY = 24 * 60 * 60 # seconds
 
-from . import backends
+ACTIVITY_SESSION_KEY = '_mongo_auth_lazyuser_activity'
 
 class LazyUserMiddleware(object):
     def process_request(self, request):
         if request.user and not isinstance(request.user, auth_models.AnonymousUser):
-            assert isinstance(request.user, backends.User)
+            assert isinstance(request.user, (backends.User, snapshot.UserSnapshot, userview.UserView))
+            self.record_activity(request)
+            return None
+
+        if getattr(settings, 'LAZYUSER_DEFERRED_SAVE', LAZYUSER_DEFERRED_SAVE):
+            # Lazy user is not saved nor stored in the session, so requests which do not
+            # save anything (like crawlers) do not cause any writes. It is logged in
+            # in process_response, once something saves it.
+            user = backends.LazyUserBackend().build_user(request)
+            user.backend = '%s.%s' % (backends.LazyUserBackend.__module__, backends.LazyUserBackend.__name__)
+            request.user = request.lazyuser = user
             return None
 
         user = auth.authenticate(request=request)
@@ -17,5 +39,33 @@ class LazyUserMiddleware(object):
         request.session[auth.SESSION_KEY] = user.id
 
         auth.login(request, user)
+        request.session[ACTIVITY_SESSION_KEY] = time.time()
 
         return None
+
+    def record_activity(self, request):
+        granularity = getattr(settings, 'LAZYUSER_ACTIVITY_GRANULARITY', LAZYUSER_ACTIVITY_GRANULARITY)
+        if not granularity or not request.user.is_lazyuser():
+            return
+
+        # Time of the last update is kept in the session, so that the user does not have to be loaded to check it
+        now = time.time()
+        if now - request.session.get(ACTIVITY_SESSION_KEY, 0) < granularity:
+            return
+
+        request.session[ACTIVITY_SESSION_KEY] = now
+        request.user.update_fields(last_login=timezone.now())
+
+    def process_response(self, request, response):
+        user = getattr(request, 'lazyuser', None)
+
+        # Lazy user has been saved during the request, but not logged in (like a third-party login does)
+        if user is not None and user.pk is not None and auth.SESSION_KEY not in request.session:
+            # We set the auth session key to prevent login to
+            # cycle the session key or flush the whole session
+            request.session[auth.SESSION_KEY] = user.id
+
+            auth.login(request, user)
+            request.session[ACTIVITY_SESSION_KEY] = time.time()
+
+        return response
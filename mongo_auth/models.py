@@ -1,21 +1,29 @@
-import hashlib, urllib
+import datetime, hashlib, urllib
 
 from django.conf import settings
-from django.contrib.auth import hashers, models as auth_models
+from django.contrib.auth import hashers, models as auth_models, signals as auth_signals
 from django.contrib.staticfiles.storage import staticfiles_storage
 from django.core import mail
 from django.test import client
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
+import bson
+
 import mongoengine
 from mongoengine.django import auth
 
-from . import utils
+from . import usercache, utils
 
 USERNAME_REGEX = r'[\w.@+-]+'
+# Until backfill_user_fields has been run, lookups also have to match users without a normalized username
+USERNAME_LOWER_FALLBACK = False
+# Until backfill_user_fields has been run, lookups also have to match users without a normalized e-mail address
+EMAIL_LOWER_FALLBACK = False
 CONFIRMATION_TOKEN_VALIDITY = 5 # days
 DEFAULT_USER_IMAGE = 'mongo_auth/images/unknown.png'
+# Last login time is not updated if stored one is more recent than this
+LAST_LOGIN_GRANULARITY = 0 # seconds
 
 # Used to reconstruct absolute/full URLs where request is not available
 DEFAULT_REQUEST = {
@@ -23,6 +31,22 @@ DEFAULT_REQUEST = {
     'SERVER_PORT': '8000',
 }
 
+_default_image_urls = {}
+
+def get_default_image_url(absolute=False):
+    """
+    Returns URL of the default user image, built once per process.
+    """
+
+    key = (getattr(settings, 'DEFAULT_USER_IMAGE', DEFAULT_USER_IMAGE), absolute)
+    if key not in _default_image_urls:
+        url = staticfiles_storage.url(key[0])
+        if absolute:
+            request = client.RequestFactory(**getattr(settings, 'DEFAULT_REQUEST', DEFAULT_REQUEST)).request()
+            url = request.build_absolute_uri(url)
+        _default_image_urls[key] = url
+    return _default_image_urls[key]
+
 class EmailConfirmationToken(mongoengine.EmbeddedDocument):
     value = mongoengine.StringField(max_length=20, required=True)
     created_time = mongoengine.DateTimeField(default=lambda: timezone.now(), required=True)
@@ -39,6 +63,122 @@ class TwitterAccessToken(mongoengine.EmbeddedDocument):
     key = mongoengine.StringField(max_length=150)
     secret = mongoengine.StringField(max_length=150)
 
+# Store full third-party profile data and access tokens in linked accounts instead of in user documents
+LINKED_ACCOUNTS = False
+
+# Keys of third-party profile data identifying the third-party user
+PROVIDER_UID_KEYS = {
+    'facebook': 'id',
+    'twitter': 'id',
+    'google': 'id',
+    'foursquare': 'id',
+    'browserid': 'email',
+}
+
+# Keys of third-party profile data which are loaded even when profile data is deferred,
+# as they are needed to tell if the user is authenticated and to display user's image
+PROFILE_DATA_SUMMARY_KEYS = {
+    'facebook_profile_data': ('id',),
+    'twitter_profile_data': ('id', 'profile_image_url'),
+    'google_profile_data': ('id', 'picture'),
+    'foursquare_profile_data': ('id', 'photo'),
+    'browserid_profile_data': ('email',),
+}
+
+class LinkedAccount(mongoengine.Document):
+    """
+    Third-party account linked with a user, storing its full profile data and access token.
+
+    Used when ``LINKED_ACCOUNTS`` setting is enabled, in which case the user document
+    keeps only a summary of profile data.
+    """
+
+    user_id = mongoengine.ObjectIdField(required=True)
+    provider = mongoengine.StringField(max_length=20, required=True)
+    # Stored as a string, as some providers use numbers
+    uid = mongoengine.StringField(max_length=255, required=True)
+    access_token = mongoengine.StringField(max_length=255)
+    # Used only by OAuth 1.0 providers
+    access_token_secret = mongoengine.StringField(max_length=150)
+    profile_data = mongoengine.DictField()
+    updated_time = mongoengine.DateTimeField(default=lambda: timezone.now(), required=True)
+
+    meta = {
+        'allow_inheritance': False,
+        'indexes': [
+            {'fields': ['provider', 'uid'], 'unique': True},
+            ('user_id', 'provider'),
+        ],
+    }
+
+# Store outgoing e-mails in a queue, sent by send_queued_mail management command, instead of sending them in the request
+EMAIL_QUEUE = False
+
+class QueuedEmail(mongoengine.Document):
+    """
+    An e-mail message waiting in the outbound queue.
+    """
+
+    subject = mongoengine.StringField(required=True)
+    body = mongoengine.StringField(required=True)
+    from_email = mongoengine.StringField()
+    to = mongoengine.ListField(mongoengine.StringField(), required=True)
+    created_time = mongoengine.DateTimeField(default=lambda: timezone.now(), required=True)
+    # Also pushed forward while a worker is sending the message, so that other workers do not send it
+    next_attempt_time = mongoengine.DateTimeField(default=lambda: timezone.now(), required=True)
+    attempts = mongoengine.IntField(default=0, required=True)
+    last_error = mongoengine.StringField()
+    # Set when all attempts have failed, message is kept for inspection
+    failed = mongoengine.BooleanField(default=False, required=True)
+
+    meta = {
+        'allow_inheritance': False,
+        'indexes': [
+            ('failed', 'next_attempt_time'),
+        ],
+    }
+
+    @classmethod
+    def enqueue(cls, subject, body, from_email, recipient_list):
+        email = cls(subject=subject, body=body, from_email=from_email, to=list(recipient_list))
+        email.save()
+        return email
+
+    def get_message(self, connection=None):
+        return mail.EmailMessage(self.subject, self.body, self.from_email, self.to, connection=connection)
+
+class ThrottleBucket(mongoengine.Document):
+    """
+    Counter of login attempts for a key in a time window, used by login throttling.
+    """
+
+    # Key and time window
+    id = mongoengine.StringField(primary_key=True)
+    count = mongoengine.IntField(default=0, required=True)
+    # Buckets are removed by a TTL index once their time window has passed
+    expires_time = mongoengine.DateTimeField(required=True)
+
+    meta = {
+        'allow_inheritance': False,
+    }
+
+class ProfileDataField(mongoengine.DictField):
+    """
+    A dict field which can be deferred, so that only its summary is loaded
+    with the document and the whole value on first access.
+    """
+
+    def __get__(self, instance, owner):
+        if instance is not None and self.name in instance._deferred_fields:
+            instance.load_deferred_fields()
+        return super(ProfileDataField, self).__get__(instance, owner)
+
+    def __set__(self, instance, value):
+        if self.name in instance._deferred_fields:
+            # Assigned value replaces the whole value, so there is nothing to load anymore
+            instance._deferred_fields = instance._deferred_fields - set([self.name])
+        super(ProfileDataField, self).__set__(instance, value)
+
 class User(auth.User):
     username = mongoengine.StringField(
         max_length=30,
@@ -48,50 +188,287 @@ class User(auth.User):
         verbose_name=_("username"),
         help_text=_("Minimal of 4 characters and maximum of 30. Letters, digits and @/./+/-/_ only."),
     )
+    # Lowercase copy of username, maintained on save, so that case-insensitive lookups can use an index
+    username_lower = mongoengine.StringField(max_length=30)
     lazyuser_username = mongoengine.BooleanField(default=True)
+    # Last login of a lazy user, maintained on save, so that abandoned lazy users can expire through a TTL index
+    lazyuser_last_login = mongoengine.DateTimeField()
 
     facebook_access_token = mongoengine.StringField(max_length=255)
-    facebook_profile_data = mongoengine.DictField()
+    facebook_profile_data = ProfileDataField()
 
     twitter_access_token = mongoengine.EmbeddedDocumentField(TwitterAccessToken)
-    twitter_profile_data = mongoengine.DictField()
+    twitter_profile_data = ProfileDataField()
 
     google_access_token = mongoengine.StringField(max_length=150)
-    google_profile_data = mongoengine.DictField()
+    google_profile_data = ProfileDataField()
 
     foursquare_access_token = mongoengine.StringField(max_length=150)
-    foursquare_profile_data = mongoengine.DictField()
+    foursquare_profile_data = ProfileDataField()
 
-    browserid_profile_data = mongoengine.DictField()
+    browserid_profile_data = ProfileDataField()
 
+    # Lowercase copy of e-mail address, maintained on save, so that case-insensitive lookups can use an index
+    email_lower = mongoengine.StringField()
     email_confirmed = mongoengine.BooleanField(default=False)
     email_confirmation_token = mongoengine.EmbeddedDocumentField(EmailConfirmationToken)
 
+    # Providers the user is linked with and whether the user has a usable password, maintained on save,
+    # so that checking whether the user is authenticated does not have to inspect profile data and password
+    linked_providers = mongoengine.ListField(mongoengine.StringField())
+    usable_password = mongoengine.BooleanField()
+    # User image URL, maintained on save, not set for users with the default image
+    image_url = mongoengine.StringField()
+
+    # Set to a new value on every change when user snapshots are enabled, so that snapshots stored in sessions can be recognized as stale
+    snapshot_version = mongoengine.StringField()
+
+    meta = {
+        'indexes': [
+            # Sparse, so that users not yet backfilled do not collide on a missing value. Sparse indexes
+            # are declared without the _types prefix MongoEngine adds for inheritable documents, as such
+            # compound index would contain every document and unique ones would collide on missing values
+            {'fields': ['username_lower'], 'unique': True, 'sparse': True, 'types': False},
+            {'fields': ['email_lower'], 'sparse': True, 'types': False},
+            # For finding abandoned lazy users
+            ('lazyuser_username', 'last_login'),
+            # Third-party identities, sparse so that only users linked with a provider are indexed
+            {'fields': ['facebook_profile_data.id'], 'unique': True, 'sparse': True, 'types': False},
+            {'fields': ['twitter_profile_data.id'], 'unique': True, 'sparse': True, 'types': False},
+            {'fields': ['google_profile_data.id'], 'unique': True, 'sparse': True, 'types': False},
+            {'fields': ['foursquare_profile_data.id'], 'unique': True, 'sparse': True, 'types': False},
+            {'fields': ['browserid_profile_data.email'], 'unique': True, 'sparse': True, 'types': False},
+            # For finding and counting users by provider
+            'linked_providers',
+        ],
+    }
+
+    # Names of fields which have not been loaded yet
+    _deferred_fields = frozenset()
+
     @classmethod
     def get_initial_fields(cls, request):
         return {}
 
+    @classmethod
+    def get_deferred_projection(cls):
+        """
+        Returns a projection for loading users with profile data fields
+        deferred, loading only their summaries.
+        """
+
+        projection = dict.fromkeys(['_cls', '_types'], True)
+        for name, field in cls._fields.items():
+            if name in PROFILE_DATA_SUMMARY_KEYS:
+                for key in PROFILE_DATA_SUMMARY_KEYS[name]:
+                    projection['%s.%s' % (field.db_field, key)] = True
+            else:
+                projection[field.db_field] = True
+        return projection
+
+    def defer_fields(self, names):
+        """
+        Marks given fields as not (fully) loaded, to be loaded on first access.
+        """
+
+        self._deferred_fields = frozenset(names)
+
+    def load_deferred_fields(self):
+        deferred, self._deferred_fields = self._deferred_fields, frozenset()
+        if not deferred or self.pk is None:
+            return
+
+        fields = [self._fields[name] for name in deferred]
+        son = self._get_collection().find_one({'_id': self.pk}, dict((field.db_field, True) for field in fields)) or {}
+        for field in fields:
+            value = son.get(field.db_field)
+            # We bypass descriptors so that loaded fields are not marked as changed
+            self._data[field.name] = None if value is None else field.to_python(value)
+
+    def peek_field(self, name):
+        """
+        Returns a value of the field as it is loaded, without loading it if it is deferred.
+        For deferred profile data fields this is just its summary.
+        """
+
+        value = self._data.get(name)
+        if value is None:
+            value = self._fields[name].default
+            if callable(value):
+                value = value()
+        return value
+
+    @classmethod
+    def username_query(cls, username):
+        """
+        Returns a query matching the given username in a case-insensitive manner.
+        """
+
+        query = mongoengine.Q(username_lower=username.lower())
+        if getattr(settings, 'USERNAME_LOWER_FALLBACK', USERNAME_LOWER_FALLBACK):
+            query |= mongoengine.Q(username_lower__exists=False, username__iexact=username)
+        return query
+
+    @classmethod
+    def email_query(cls, email):
+        """
+        Returns a query matching the given e-mail address in a case-insensitive manner.
+        """
+
+        query = mongoengine.Q(email_lower=email.lower())
+        if getattr(settings, 'EMAIL_LOWER_FALLBACK', EMAIL_LOWER_FALLBACK):
+            query |= mongoengine.Q(email_lower__exists=False, email__iexact=email)
+        return query
+
+    def get_derived_fields(self):
+        """
+        Returns values of fields which are computed from other fields and maintained on save.
+        """
+
+        usable_password = hashers.is_password_usable(self.password)
+        linked_providers = self.get_linked_providers()
+
+        return {
+            'username_lower': self.username.lower() if self.username else None,
+            'email_lower': self.email.lower() if self.email else None,
+            'linked_providers': linked_providers,
+            'usable_password': usable_password,
+            'image_url': self.build_image_url(),
+            # Computed from values above, as stored values might not be updated yet
+            'lazyuser_last_login': self.last_login if self.lazyuser_username and not (usable_password or linked_providers) else None,
+        }
+
+    def get_linked_providers(self):
+        # We peek so that deferred profile data is not loaded
+        return [provider for provider in sorted(PROVIDER_UID_KEYS) if self.peek_field('%s_profile_data' % provider)]
+
+    def save(self, *args, **kwargs):
+        # Saving accesses all fields, so we load deferred fields explicitly before
+        self.load_deferred_fields()
+        for name, value in self.get_derived_fields().items():
+            setattr(self, name, value)
+        snapshot_version = None
+        if self.pk is None or self._get_changed_fields():
+            # Stored together with other changes
+            snapshot_version = self.new_snapshot_version()
+            if snapshot_version is not None:
+                self.snapshot_version = snapshot_version
+        result = super(User, self).save(*args, **kwargs)
+        if snapshot_version is not None:
+            self.record_snapshot_version(self.pk, snapshot_version)
+        return result
+
+    @classmethod
+    def new_snapshot_version(cls):
+        """
+        Returns a new snapshot version to store with a change of the user, or ``None``
+        if user snapshots are not enabled.
+        """
+
+        # Imported here, as it imports backends which import this module
+        from . import snapshot
+
+        if not getattr(settings, 'USER_SNAPSHOT', snapshot.USER_SNAPSHOT):
+            return None
+        return str(bson.ObjectId())
+
+    @classmethod
+    def record_snapshot_version(cls, user_id, snapshot_version):
+        """
+        Records the snapshot version which has been stored with a change of the user.
+        """
+
+        from . import snapshot
+
+        snapshot.set_stored_version(user_id, snapshot_version)
+
+    @classmethod
+    def get_update(cls, fields):
+        """
+        Returns update document which sets given fields, unsetting those which are ``None``.
+        """
+
+        update = {}
+        for name, value in fields.items():
+            field = cls._fields[name]
+            if value is None:
+                update.setdefault('$unset', {})[field.db_field] = 1
+            else:
+                update.setdefault('$set', {})[field.db_field] = field.to_mongo(value)
+        return update
+
+    def update_fields(self, **fields):
+        """
+        Sets given fields and stores only them, together with derived fields
+        they change, instead of saving the whole document. A user which has
+        not been saved yet is saved whole.
+        """
+
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+        if self.pk is None:
+            self.save()
+            return self
+
+        for name, value in self.get_derived_fields().items():
+            if self._data.get(name) != value:
+                setattr(self, name, value)
+                fields[name] = value
+
+        if not fields:
+            # An empty update would replace the whole document
+            return self
+
+        snapshot_version = self.new_snapshot_version()
+        if snapshot_version is not None:
+            self.snapshot_version = fields['snapshot_version'] = snapshot_version
+
+        for name, value in fields.items():
+            if value is not None:
+                self._fields[name].validate(value)
+
+        self._get_collection().update({'_id': self.pk}, self.get_update(fields), safe=True)
+
+        # Stored fields are not changed anymore for a later save
+        db_fields = set(self._fields[name].db_field for name in fields)
+        self._changed_fields = [key for key in getattr(self, '_changed_fields', []) if key.split('.')[0] not in db_fields]
+
+        usercache.invalidate(self.pk)
+        if snapshot_version is not None:
+            self.record_snapshot_version(self.pk, snapshot_version)
+
+        return self
+
     def is_anonymous(self):
         return not self.is_authenticated()
 
     def is_authenticated(self):
+        usable_password = self.peek_field('usable_password')
+        if usable_password is not None:
+            return usable_password or bool(self.peek_field('linked_providers'))
+
+        # User has not been saved since maintained fields were introduced
         # TODO: Check if *_data fields are really false if not linked with third-party authentication
-        return self.has_usable_password() or \
-            self.facebook_profile_data or \
-            self.twitter_profile_data or \
-            self.google_profile_data or \
-            self.foursquare_profile_data or \
-            self.browserid_profile_data
+        return self.has_usable_password() or bool(self.get_linked_providers())
+
+    def is_lazyuser(self):
+        """
+        Returns ``True`` if the user is a lazy user which has not been converted to an account.
+        """
+
+        return bool(self.lazyuser_username and not self.is_authenticated())
 
     def check_password(self, raw_password):
         def setter(raw_password):
             self.set_password(raw_password)
         return hashers.check_password(raw_password, self.password, setter)
 
+    def set_password(self, raw_password):
+        return self.update_fields(password=hashers.make_password(raw_password))
+
     def set_unusable_password(self):
-        self.password = hashers.make_password(None)
-        self.save()
-        return self
+        return self.update_fields(password=hashers.make_password(None))
 
     def has_usable_password(self):
         return hashers.is_password_usable(self.password)
@@ -101,39 +478,56 @@ class User(auth.User):
             raise ValueError("Account e-mail address not set.")
         if not allow_unconfirmed and not self.email_confirmed:
             raise ValueError("Account e-mail address not confirmed.")
-        mail.send_mail(subject, message, from_email, [self.email])
+        if getattr(settings, 'EMAIL_QUEUE', EMAIL_QUEUE):
+            QueuedEmail.enqueue(subject, message, from_email, [self.email])
+        else:
+            mail.send_mail(subject, message, from_email, [self.email])
 
     def get_image_url(self):
-        if self.twitter_profile_data and 'profile_image_url' in self.twitter_profile_data:
-            return self.twitter_profile_data['profile_image_url']
-
-        elif self.facebook_profile_data:
+        image_url = self.peek_field('image_url')
+        if image_url:
+            return image_url
+        # User has the default image or has not been saved since image URL is stored
+        return self.build_image_url() or get_default_image_url()
+
+    def build_image_url(self):
+        """
+        Returns URL of the user image, or ``None`` if the user has the default image.
+        """
+
+        # We peek so that deferred profile data is not loaded, summaries contain all keys we need
+        twitter_profile_data = self.peek_field('twitter_profile_data')
+        facebook_profile_data = self.peek_field('facebook_profile_data')
+        foursquare_profile_data = self.peek_field('foursquare_profile_data')
+        google_profile_data = self.peek_field('google_profile_data')
+
+        if twitter_profile_data and 'profile_image_url' in twitter_profile_data:
+            return twitter_profile_data['profile_image_url']
+
+        elif facebook_profile_data:
             # TODO: Do we really need this utils/graph_api_url?
             return '%s?type=square' % utils.graph_api_url('%s/picture' % self.username)
 
-        elif self.foursquare_profile_data and 'photo' in self.foursquare_profile_data:
-            return self.foursquare_profile_data['photo']
+        elif foursquare_profile_data and 'photo' in foursquare_profile_data:
+            return foursquare_profile_data['photo']
 
-        elif self.google_profile_data and 'picture' in self.google_profile_data:
-            return self.google_profile_data['picture']
+        elif google_profile_data and 'picture' in google_profile_data:
+            return google_profile_data['picture']
 
         elif self.email:
-            request = client.RequestFactory(**getattr(settings, 'DEFAULT_REQUEST', DEFAULT_REQUEST)).request()
-            default_url = request.build_absolute_uri(staticfiles_storage.url(getattr(settings, 'DEFAULT_USER_IMAGE', DEFAULT_USER_IMAGE)))
-
             return 'https://secure.gravatar.com/avatar/%(email_hash)s?%(args)s' % {
                 'email_hash': hashlib.md5(self.email.lower()).hexdigest(),
                 'args': urllib.urlencode({
-                    'default': default_url,
+                    'default': get_default_image_url(absolute=True),
                     'size': 50,
                 }),
             }
 
         else:
-            return staticfiles_storage.url(getattr(settings, 'DEFAULT_USER_IMAGE', DEFAULT_USER_IMAGE))
+            return None
 
     @classmethod
-    def create_user(cls, username, email=None, password=None, lazyuser=False):
+    def create_user(cls, username, email=None, password=None, lazyuser=False, save=True):
         now = timezone.now()
         if not username:
             raise ValueError("The given username must be set")
@@ -148,11 +542,70 @@ class User(auth.User):
             last_login=now,
             date_joined=now,
         )
-        user.set_password(password)
-        user.save()
+        # We do not use set_password as it also saves the user
+        if password is None:
+            # Lazy users have no password, so we skip hashers altogether
+            user.password = hashers.UNUSABLE_PASSWORD
+        else:
+            user.password = hashers.make_password(password)
+        if save:
+            user.save()
         return user
 
+    def get_linked_account(self, provider):
+        """
+        Returns the linked account of the given provider, or ``None``.
+        """
+
+        return LinkedAccount.objects(user_id=self.pk, provider=provider).first()
+
+    def get_access_token(self, provider):
+        """
+        Returns the access token of the given provider, from the linked account when
+        linked accounts are enabled, or ``None``.
+        """
+
+        if not getattr(settings, 'LINKED_ACCOUNTS', LINKED_ACCOUNTS):
+            return getattr(self, '%s_access_token' % provider, None)
+
+        linked_account = self.get_linked_account(provider)
+        if linked_account is None:
+            return None
+        if linked_account.access_token_secret is not None:
+            return TwitterAccessToken(key=linked_account.access_token, secret=linked_account.access_token_secret)
+        return linked_account.access_token
+
+    @classmethod
+    def get_profile_data_summary(cls, provider, profile_data):
+        """
+        Returns the part of profile data of the given provider which is kept in
+        the user document when linked accounts are enabled.
+        """
+
+        return dict((key, profile_data[key]) for key in PROFILE_DATA_SUMMARY_KEYS['%s_profile_data' % provider] if key in profile_data)
+
+    def store_linked_account(self, provider, profile_data, access_token=None):
+        """
+        Stores profile data and access token of the given provider into a linked
+        account of the user. The user document is not changed.
+        """
+
+        access_token_secret = None
+        if isinstance(access_token, TwitterAccessToken):
+            access_token, access_token_secret = access_token.key, access_token.secret
+
+        LinkedAccount.objects(provider=provider, uid=unicode(profile_data[PROVIDER_UID_KEYS[provider]])).update_one(
+            upsert=True,
+            set__user_id=self.pk,
+            set__access_token=access_token,
+            set__access_token_secret=access_token_secret,
+            set__profile_data=profile_data,
+            set__updated_time=timezone.now(),
+        )
+
     def authenticate_facebook(self, request):
+        self.linked_providers = self.get_linked_providers()
+
         if self.lazyuser_username and self.facebook_profile_data.get('username'):
             # TODO: Does Facebook have same restrictions on username content as we do?
             self.username = self.facebook_profile_data.get('username')
@@ -167,6 +620,8 @@ class User(auth.User):
             self.email = self.facebook_profile_data.get('email') or None
 
     def authenticate_twitter(self, request):
+        self.linked_providers = self.get_linked_providers()
+
         if self.lazyuser_username and self.twitter_profile_data.get('screen_name'):
             # TODO: Does Twitter have same restrictions on username content as we do?
             self.username = self.twitter_profile_data.get('screen_name')
@@ -175,6 +630,8 @@ class User(auth.User):
             self.first_name = self.twitter_profile_data.get('name') or None
 
     def authenticate_google(self, request):
+        self.linked_providers = self.get_linked_providers()
+
         username_guess = self.google_profile_data.get('email', '').rsplit('@', 1)[0]
 
         if self.lazyuser_username and username_guess:
@@ -191,6 +648,8 @@ class User(auth.User):
                 self.email_confirmed = True
 
     def authenticate_foursquare(self, request):
+        self.linked_providers = self.get_linked_providers()
+
         username_guess = self.foursquare_profile_data.get('contact', {}).get('email', '').rsplit('@', 1)[0]
 
         if self.lazyuser_username and username_guess:
@@ -205,6 +664,8 @@ class User(auth.User):
             self.email = self.foursquare_profile_data.get('contact', {}).get('email') or None
 
     def authenticate_browserid(self, request):
+        self.linked_providers = self.get_linked_providers()
+
         if self.lazyuser_username:
             # Best username guess we can get from BrowserID
             self.username = self.browserid_profile_data['email'].rsplit('@', 1)[0]
@@ -216,3 +677,30 @@ class User(auth.User):
 
     def authenticate_lazyuser(self, request):
         pass
+
+def invalidate_user_cache(sender, document, **kwargs):
+    if isinstance(document, User):
+        usercache.invalidate(document.pk)
+
+if mongoengine.signals.signals_available:
+    mongoengine.signals.post_save.connect(invalidate_user_cache)
+    mongoengine.signals.post_delete.connect(invalidate_user_cache)
+
+def update_last_login(sender, user, **kwargs):
+    """
+    Replaces Django's receiver, which saves the whole user document on every login,
+    with a targeted update of last login time (and derived fields) for our users.
+    """
+
+    if not isinstance(user, User):
+        return auth_models.update_last_login(sender, user, **kwargs)
+
+    now = timezone.now()
+    granularity = getattr(settings, 'LAST_LOGIN_GRANULARITY', LAST_LOGIN_GRANULARITY)
+    if granularity and user.pk is not None and user.last_login and now - user.last_login < datetime.timedelta(seconds=granularity):
+        return
+
+    user.update_fields(last_login=now)
+
+auth_signals.user_logged_in.disconnect(auth_models.update_last_login)
+auth_signals.user_logged_in.connect(update_last_login)
@@ -0,0 +1,200 @@
+from django import dispatch
+from django.conf import settings
+from django.contrib import auth
+from django.contrib.auth import signals as auth_signals
+from django.core import cache as django_cache, signing
+from django.utils import functional
+
+import bson
+
+from . import backends, userview
+
+# Serve request.user from a snapshot stored in the session, loading the user document only when needed
+USER_SNAPSHOT = False
+# Snapshots older than this are refreshed, even if the user has not changed
+USER_SNAPSHOT_MAX_AGE = 5 * 60 # seconds
+# Fields of the user document stored in the snapshot, fields the user class does not have are skipped
+USER_SNAPSHOT_FIELDS = ('username', 'first_name', 'last_name', 'lazyuser_username', 'language')
+# Fields never stored in the snapshot, so that changes of permissions apply immediately
+UNSNAPSHOTTABLE_FIELDS = ('password', 'is_active', 'is_staff', 'is_superuser')
+# Name of a cache configured in Django CACHES, shared between processes, keeping current snapshot versions of users
+USER_SNAPSHOT_CACHE = 'default'
+
+SNAPSHOT_SESSION_KEY = '_mongo_auth_user_snapshot'
+
+def make_snapshot(user):
+    fields = getattr(settings, 'USER_SNAPSHOT_FIELDS', USER_SNAPSHOT_FIELDS)
+    return {
+        'id': str(user.pk),
+        'version': user.snapshot_version or '',
+        'fields': dict((name, getattr(user, name)) for name in fields if name in user._fields and name not in UNSNAPSHOTTABLE_FIELDS),
+        'authenticated': user.is_authenticated(),
+        'image_url': user.get_image_url(),
+    }
+
+def store_snapshot(request, user):
+    snapshot = make_snapshot(user)
+    request.session[SNAPSHOT_SESSION_KEY] = signing.dumps(snapshot, salt='mongo_auth.snapshot')
+    set_stored_version(user.pk, snapshot['version'])
+
+def load_snapshot(request, user_id):
+    """
+    Returns snapshot stored in the session for the given user id, or ``None`` if
+    there is none, or it has been tampered with or has expired.
+    """
+
+    try:
+        snapshot = signing.loads(request.session[SNAPSHOT_SESSION_KEY], salt='mongo_auth.snapshot', max_age=getattr(settings, 'USER_SNAPSHOT_MAX_AGE', USER_SNAPSHOT_MAX_AGE))
+    except (KeyError, signing.BadSignature):
+        return None
+    if snapshot.get('id') != str(user_id):
+        return None
+    stored_version = get_stored_version(user_id)
+    if stored_version is None or snapshot.get('version') != stored_version:
+        # User has been changed since the snapshot was made, or we do not know
+        return None
+    return snapshot
+
+def get_version_cache():
+    return django_cache.get_cache(getattr(settings, 'USER_SNAPSHOT_CACHE', USER_SNAPSHOT_CACHE))
+
+def get_version_key(user_id):
+    return 'mongo_auth.snapshot.version.%s' % user_id
+
+def get_stored_version(user_id):
+    """
+    Returns the current snapshot version of the user from the cache, or ``None``
+    if it is not known. The database is not queried.
+    """
+
+    return get_version_cache().get(get_version_key(user_id))
+
+def set_stored_version(user_id, version):
+    """
+    Records the current snapshot version of the user. Entries are not needed
+    for longer than snapshots are valid.
+    """
+
+    get_version_cache().set(get_version_key(user_id), version or '', getattr(settings, 'USER_SNAPSHOT_MAX_AGE', USER_SNAPSHOT_MAX_AGE))
+
+class UserSnapshot(object):
+    """
+    Read-only user object serving fields stored in the snapshot. Accessing any
+    other field, setting a field or calling any other method (like ``save``)
+    loads the user document and is delegated to it.
+    """
+
+    # Set by Django on the user object, we do not want to load the user document for it
+    local_attributes = ('backend',)
+
+    def __init__(self, snapshot, loader):
+        self.__dict__['snapshot'] = snapshot
+        self.__dict__['loader'] = loader
+        self.__dict__['user'] = None
+
+    def get_user(self):
+        if self.__dict__['user'] is None:
+            user = self.__dict__['loader']()
+            if user is None:
+                raise backends.User.DoesNotExist("User %s from the snapshot does not exist." % self.snapshot['id'])
+            if 'backend' in self.__dict__:
+                user.backend = self.__dict__['backend']
+            self.__dict__['user'] = user
+        return self.__dict__['user']
+
+    def is_loaded(self):
+        return self.__dict__['user'] is not None
+
+    def __getattr__(self, name):
+        if not self.is_loaded() and name in self.snapshot['fields']:
+            return self.snapshot['fields'][name]
+        return getattr(self.get_user(), name)
+
+    def __setattr__(self, name, value):
+        if name in self.local_attributes:
+            self.__dict__[name] = value
+            if not self.is_loaded():
+                return
+        setattr(self.get_user(), name, value)
+
+    def __eq__(self, other):
+        return self.pk == getattr(other, 'pk', None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __unicode__(self):
+        return self.username
+
+    @property
+    def pk(self):
+        return bson.ObjectId(self.snapshot['id'])
+
+    id = pk
+
+    def is_authenticated(self):
+        if self.is_loaded():
+            return self.get_user().is_authenticated()
+        return self.snapshot['authenticated']
+
+    def is_anonymous(self):
+        return not self.is_authenticated()
+
+    def is_lazyuser(self):
+        if self.is_loaded():
+            return self.get_user().is_lazyuser()
+        return bool(self.snapshot['fields'].get('lazyuser_username')) and not self.snapshot['authenticated']
+
+    def get_image_url(self):
+        if self.is_loaded():
+            return self.get_user().get_image_url()
+        return self.snapshot['image_url']
+
+def get_user(request):
+    user_id = request.session.get(auth.SESSION_KEY)
+    if user_id is not None:
+        snapshot = load_snapshot(request, user_id)
+        if snapshot is not None:
+            user = UserSnapshot(snapshot, lambda: auth.get_user(request))
+            user.backend = request.session.get(auth.BACKEND_SESSION_KEY)
+            request.snapshot_user, request.snapshot_version = user, snapshot['version']
+            return user
+
+    user = auth.get_user(request)
+    if isinstance(user, (backends.User, userview.UserView)) and user.pk is not None:
+        store_snapshot(request, user)
+        request.snapshot_user, request.snapshot_version = user, user.snapshot_version or ''
+    return user
+
+class UserSnapshotMiddleware(object):
+    """
+    Serves ``request.user`` from a signed user snapshot stored in the session,
+    so that requests which need only fields in the snapshot do not load the user
+    document. Has to be placed just after ``AuthenticationMiddleware``.
+    """
+
+    def process_request(self, request):
+        if getattr(settings, 'USER_SNAPSHOT', USER_SNAPSHOT):
+            request.user = functional.SimpleLazyObject(lambda: get_user(request))
+        return None
+
+    def process_response(self, request, response):
+        user = getattr(request, 'snapshot_user', None)
+        if isinstance(user, UserSnapshot):
+            user = user.get_user() if user.is_loaded() else None
+        if isinstance(user, userview.UserView):
+            user = user.get_user() if user.is_loaded() else None
+
+        # User has changed during the request, and is still the one logged in
+        if user is not None and (user.snapshot_version or '') != request.snapshot_version and str(user.pk) == str(request.session.get(auth.SESSION_KEY)):
+            store_snapshot(request, user)
+
+        return response
+
+@dispatch.receiver(auth_signals.user_logged_in)
+def store_snapshot_on_login(sender, request, user, **kwargs):
+    if getattr(settings, 'USER_SNAPSHOT', USER_SNAPSHOT) and isinstance(user, backends.User):
+        store_snapshot(request, user)
@@ -0,0 +1,195 @@
+import json, threading, time, unittest
+
+from django.conf import settings
+from django.contrib.auth import tokens
+from django.contrib.messages.storage import cookie
+from django.test import client, utils as test_utils
+from django.utils import importlib
+
+import bson
+
+try:
+    import jwt
+    from jwt import algorithms as jwt_algorithms
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import rsa
+except ImportError:
+    jwt = None
+
+from . import backends, forms, idtoken, throttle, views
+
+class ObjectIdBase36Test(unittest.TestCase):
+    def assertRoundTrip(self, objectid):
+        s = forms.objectid_to_base36(objectid)
+        self.assertTrue(len(s) <= forms.OBJECTID_BASE36_MAX_LENGTH, s)
+        self.assertEqual(forms.base36_to_objectid(s), objectid)
+
+    def test_round_trip(self):
+        for i in range(1000):
+            self.assertRoundTrip(bson.ObjectId())
+
+    def test_leading_zeros(self):
+        for value in ('0' * 24, '0' * 23 + '1', '00000000abcdef0123456789', '000102030405060708090a0b', '0fffffffffffffffffffffff'):
+            self.assertRoundTrip(bson.ObjectId(value))
+        self.assertEqual(forms.objectid_to_base36(bson.ObjectId('0' * 24)), '0')
+        self.assertEqual(forms.objectid_to_base36(bson.ObjectId('0' * 23 + 'a')), 'a')
+
+    def test_largest(self):
+        self.assertRoundTrip(bson.ObjectId('f' * 24))
+        self.assertEqual(len(forms.objectid_to_base36(bson.ObjectId('f' * 24))), forms.OBJECTID_BASE36_MAX_LENGTH)
+
+    def test_invalid(self):
+        for s in ('', '-', '-1', ' 1', 'ABC', 'abc$', '1' * (forms.OBJECTID_BASE36_MAX_LENGTH + 1), forms.objectid_to_base36(bson.ObjectId('f' * 24))[:-1] + 'z'):
+            self.assertRaises(ValueError, forms.base36_to_objectid, s)
+
+    def test_threads(self):
+        errors = []
+
+        def convert():
+            try:
+                for i in range(1000):
+                    self.assertRoundTrip(bson.ObjectId())
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=convert) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+class PasswordResetConfirmTest(unittest.TestCase):
+    USERS = 20
+
+    def setUp(self):
+        self.users = []
+        for i in range(self.USERS):
+            user = backends.User(username='reset-test-%s' % bson.ObjectId(), email='reset-test-%d@example.com' % i)
+            user.set_password('old-password')
+            user.save()
+            self.users.append(user)
+
+    def tearDown(self):
+        backends.User.objects(pk__in=[user.pk for user in self.users]).delete()
+
+    def reset(self, user, password):
+        request = client.RequestFactory().post('/', {
+            'new_password1': password,
+            'new_password2': password,
+        })
+        request._messages = cookie.CookieStorage(request)
+        return views.password_reset_confirm(request, uidb36=forms.objectid_to_base36(user.pk), token=tokens.default_token_generator.make_token(user), post_reset_redirect='/done/')
+
+    def test_reset(self):
+        user = self.users[0]
+        response = self.reset(user, 'new-password')
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(backends.User.objects.get(pk=user.pk).check_password('new-password'))
+
+    def test_invalid_uid(self):
+        request = client.RequestFactory().get('/')
+        for uidb36 in ('-1', 'z' * (forms.OBJECTID_BASE36_MAX_LENGTH + 1), forms.objectid_to_base36(bson.ObjectId())):
+            response = views.password_reset_confirm(request, uidb36=uidb36, token='1-1', post_reset_redirect='/done/')
+            self.assertFalse(response.context_data['validlink'])
+
+    def test_parallel_resets(self):
+        start = threading.Event()
+        responses = {}
+        errors = []
+
+        def reset(user):
+            start.wait()
+            try:
+                responses[user.pk] = self.reset(user, 'new-password-%s' % user.pk)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=reset, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        for user in self.users:
+            self.assertEqual(responses[user.pk].status_code, 302)
+            # Every reset has changed its own user's password
+            self.assertTrue(backends.User.objects.get(pk=user.pk).check_password('new-password-%s' % user.pk))
+
+class LoginThrottleTest(unittest.TestCase):
+    def setUp(self):
+        self.previous_throttle = throttle._throttle
+        throttle._throttle = throttle.LocalThrottle()
+
+    def tearDown(self):
+        throttle._throttle = self.previous_throttle
+
+    def login(self, ip):
+        # Without credentials, so that attempts are not throttled by username
+        request = client.RequestFactory().post('/', {}, REMOTE_ADDR=ip)
+        request._dont_enforce_csrf_checks = True
+        request.session = importlib.import_module(settings.SESSION_ENGINE).SessionStore()
+        return views.login(request)
+
+    def test_ip_limit(self):
+        with test_utils.override_settings(LOGIN_THROTTLE=True, LOGIN_THROTTLE_BACKEND='mongo_auth.throttle.LocalThrottle', LOGIN_THROTTLE_LIMITS={'ip': 100}):
+            for i in range(100):
+                self.assertFalse(self.login('192.0.2.1').context_data['form'].throttled)
+
+            form = self.login('192.0.2.1').context_data['form']
+            self.assertTrue(form.throttled)
+            self.assertTrue(form.non_field_errors())
+
+            # Other addresses are counted separately
+            self.assertFalse(self.login('192.0.2.2').context_data['form'].throttled)
+
+@unittest.skipIf(jwt is None, "Verifying ID tokens requires PyJWT and cryptography to be installed.")
+class GoogleIdTokenTest(unittest.TestCase):
+    CLIENT_ID = 'test-client-id.apps.googleusercontent.com'
+
+    def setUp(self):
+        self.private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+        jwk = json.loads(jwt_algorithms.RSAAlgorithm.to_jwk(self.private_key.public_key()))
+        jwk['kid'] = 'test-key'
+        self.key_set = idtoken.KeySet('https://example.com/certs', 'google', 60 * 60)
+        self.key_set.set_keys({'keys': [jwk]})
+
+    def make_token(self, kid='test-key', **claims):
+        now = int(time.time())
+        token_claims = {
+            'iss': 'https://accounts.google.com',
+            'aud': self.CLIENT_ID,
+            'iat': now,
+            'exp': now + 60 * 60,
+            'sub': '1234567890',
+            'email': 'user@example.com',
+            'email_verified': 'true',
+            'name': "Test User",
+        }
+        token_claims.update(claims)
+        return jwt.encode(token_claims, self.private_key, algorithm='RS256', headers={'kid': kid})
+
+    def get_profile_data(self, id_token):
+        with test_utils.override_settings(GOOGLE_VERIFY_ID_TOKEN=True, GOOGLE_CLIENT_ID=self.CLIENT_ID):
+            return idtoken.get_google_profile_data({'access_token': 'token', 'id_token': id_token}, self.key_set)
+
+    def test_valid(self):
+        self.assertEqual(self.get_profile_data(self.make_token()), {
+            'id': '1234567890',
+            'email': 'user@example.com',
+            'verified_email': True,
+            'name': "Test User",
+        })
+
+    def test_invalid(self):
+        # All of these fall back to the userinfo endpoint
+        self.assertEqual(self.get_profile_data(self.make_token(aud='other-client-id')), None)
+        self.assertEqual(self.get_profile_data(self.make_token(iss='https://example.com')), None)
+        self.assertEqual(self.get_profile_data(self.make_token(exp=int(time.time()) - 60)), None)
+        self.assertEqual(self.get_profile_data(self.make_token(kid='unknown-key')), None)
+
+    def test_disabled(self):
+        with test_utils.override_settings(GOOGLE_VERIFY_ID_TOKEN=False):
+            self.assertEqual(idtoken.get_google_profile_data({'access_token': 'token', 'id_token': self.make_token()}, self.key_set), None)
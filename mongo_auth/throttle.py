@@ -0,0 +1,147 @@
+import collections, datetime, logging, threading, time
+
+from django.conf import settings
+from django.core import exceptions
+from django.utils import importlib
+
+from pymongo import errors
+
+from . import models
+
+# Reject login attempts over limits, before the password hash is computed
+LOGIN_THROTTLE = False
+LOGIN_THROTTLE_BACKEND = 'mongo_auth.throttle.LocalThrottle'
+# Length of fixed time windows in which attempts are counted
+LOGIN_THROTTLE_WINDOW = 5 * 60 # seconds
+# Maximal number of attempts in a time window, by scope
+LOGIN_THROTTLE_LIMITS = {
+    'username': 10,
+    'ip': 100,
+}
+# Request header with client IP address, for example HTTP_X_FORWARDED_FOR behind a proxy, by default REMOTE_ADDR
+LOGIN_THROTTLE_IP_HEADER = None
+# Maximal number of counters kept by the in-process backend
+LOGIN_THROTTLE_LOCAL_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+class LocalThrottle(object):
+    """
+    Counts attempts in the current process only. Counters of the current time
+    window are kept, at most ``LOGIN_THROTTLE_LOCAL_SIZE`` of them, evicting
+    least recently used ones.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.window_index = None
+        self.counters = collections.OrderedDict()
+
+    def increment(self, key, window_index, window):
+        with self.lock:
+            if window_index != self.window_index:
+                # All counters are from a past time window
+                self.window_index = window_index
+                self.counters = collections.OrderedDict()
+
+            # We reinsert the counter to mark it as most recently used
+            count = self.counters.pop(key, 0) + 1
+            self.counters[key] = count
+            if len(self.counters) > getattr(settings, 'LOGIN_THROTTLE_LOCAL_SIZE', LOGIN_THROTTLE_LOCAL_SIZE):
+                self.counters.popitem(last=False)
+            return count
+
+class MongoThrottle(object):
+    """
+    Counts attempts in the database, shared between processes, with atomic
+    increments. Counters expire through a TTL index.
+    """
+
+    def __init__(self):
+        self.collection = models.ThrottleBucket._get_collection()
+        self.collection.ensure_index('expires_time', expireAfterSeconds=0)
+
+    def increment(self, key, window_index, window):
+        bucket_id = '%s:%d' % (key, window_index)
+        # TTL indexes compare with UTC time
+        expires_time = datetime.datetime.utcfromtimestamp((window_index + 1) * window)
+        update = {'$inc': {'count': 1}, '$set': {'expires_time': expires_time}}
+
+        try:
+            son = self.collection.find_and_modify({'_id': bucket_id}, update, upsert=True, new=True)
+        except errors.OperationFailure, e:
+            # Imported here, as backends import this module
+            from . import backends
+
+            if not backends.is_duplicate_key_error(e):
+                raise
+            # Concurrent insert of the same bucket, now it exists
+            son = self.collection.find_and_modify({'_id': bucket_id}, update, upsert=True, new=True)
+        return son['count']
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+_counters = collections.defaultdict(int)
+_counters_lock = threading.Lock()
+
+def get_throttle():
+    """
+    Returns the throttle backend configured with ``LOGIN_THROTTLE_BACKEND`` setting.
+    """
+
+    global _throttle
+
+    if _throttle is None:
+        with _throttle_lock:
+            if _throttle is None:
+                path = getattr(settings, 'LOGIN_THROTTLE_BACKEND', LOGIN_THROTTLE_BACKEND)
+                module, attr = path.rsplit('.', 1)
+                try:
+                    throttle_class = getattr(importlib.import_module(module), attr)
+                except (ImportError, AttributeError), e:
+                    raise exceptions.ImproperlyConfigured('Error importing login throttle backend %s: "%s"' % (path, e))
+                _throttle = throttle_class()
+
+    return _throttle
+
+def allow(scope, value):
+    """
+    Counts a login attempt for the given scope (``username`` or ``ip``) and value
+    and returns whether it is allowed.
+    """
+
+    if not getattr(settings, 'LOGIN_THROTTLE', LOGIN_THROTTLE) or not value:
+        return True
+
+    limit = getattr(settings, 'LOGIN_THROTTLE_LIMITS', LOGIN_THROTTLE_LIMITS).get(scope)
+    if limit is None:
+        return True
+
+    window = getattr(settings, 'LOGIN_THROTTLE_WINDOW', LOGIN_THROTTLE_WINDOW)
+    window_index = int(time.time() // window)
+    count = get_throttle().increment('%s:%s' % (scope, value), window_index, window)
+
+    allowed = count <= limit
+    with _counters_lock:
+        _counters['%s_%s' % ('allowed' if allowed else 'rejected', scope)] += 1
+    if count == limit + 1:
+        # We log only the first rejection in a time window
+        logger.warning("Login attempts for %s %s throttled after %d attempts in %d seconds", scope, value, limit, window)
+
+    return allowed
+
+def get_client_ip(request):
+    header = getattr(settings, 'LOGIN_THROTTLE_IP_HEADER', LOGIN_THROTTLE_IP_HEADER)
+    if header and request.META.get(header):
+        # Our proxy appends the address it sees last, earlier ones can be forged by the client
+        return request.META[header].split(',')[-1].strip()
+    return request.META.get('REMOTE_ADDR')
+
+def get_stats():
+    """
+    Returns numbers of allowed and rejected login attempts in this process, by scope.
+    """
+
+    with _counters_lock:
+        return dict(_counters)
@@ -0,0 +1,97 @@
+import json, threading
+
+from django.conf import settings
+from django.core import exceptions
+from django.utils import importlib
+
+import requests
+from requests import adapters
+from requests.packages.urllib3.util import retry
+
+HTTP_TRANSPORT = 'mongo_auth.transport.PooledTransport'
+HTTP_TIMEOUT = (5, 15) # connect and read timeouts, in seconds
+HTTP_RETRIES = 2 # retries of failed connections
+HTTP_POOL_SIZE = 10 # connections kept alive per host
+
+class TransportError(Exception):
+    """
+    Raised when a request to a third-party provider fails.
+    """
+
+class PooledTransport(object):
+    """
+    HTTP transport which keeps connections alive in a pool and bounds
+    requests with timeouts.
+
+    Only failed connection attempts are retried, when nothing has been sent
+    yet, so requests which are not idempotent (like exchanging an authorization
+    code) are never sent twice. Read errors and error responses are not retried.
+    """
+
+    def __init__(self):
+        pool_size = getattr(settings, 'HTTP_POOL_SIZE', HTTP_POOL_SIZE)
+        self.timeout = getattr(settings, 'HTTP_TIMEOUT', HTTP_TIMEOUT)
+        self.session = requests.Session()
+        retries = getattr(settings, 'HTTP_RETRIES', HTTP_RETRIES)
+        # An integer would also retry read errors, sending a request again after a read timeout
+        max_retries = retry.Retry(total=retries, connect=retries, read=False, status=0)
+        adapter = adapters.HTTPAdapter(pool_maxsize=pool_size, max_retries=max_retries)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, url, params=None, data=None):
+        """
+        Makes a request and returns the response body.
+
+        Client errors are returned as providers describe them in the body,
+        connection errors, timeouts and server errors raise ``TransportError``.
+        """
+
+        try:
+            response = self.session.request(method, url, params=params, data=data, timeout=self.timeout)
+        except requests.RequestException, e:
+            raise TransportError("%s %s failed: %s" % (method, url, e))
+
+        if response.status_code >= 500:
+            raise TransportError("%s %s failed with status %d" % (method, url, response.status_code))
+
+        return response.content
+
+_transport = None
+_transport_lock = threading.Lock()
+
+def get_transport():
+    """
+    Returns the HTTP transport configured with ``HTTP_TRANSPORT`` setting.
+    It can be set to a stub class in tests.
+    """
+
+    global _transport
+
+    if _transport is None:
+        with _transport_lock:
+            if _transport is None:
+                path = getattr(settings, 'HTTP_TRANSPORT', HTTP_TRANSPORT)
+                module, attr = path.rsplit('.', 1)
+                try:
+                    transport_class = getattr(importlib.import_module(module), attr)
+                except (ImportError, AttributeError), e:
+                    raise exceptions.ImproperlyConfigured('Error importing HTTP transport %s: "%s"' % (path, e))
+                _transport = transport_class()
+
+    return _transport
+
+def request(method, url, params=None, data=None):
+    return get_transport().request(method, url, params=params, data=data)
+
+def get_json(url, params=None):
+    return decode_json(request('GET', url, params=params), url)
+
+def post_json(url, data=None):
+    return decode_json(request('POST', url, data=data), url)
+
+def decode_json(body, url):
+    try:
+        return json.loads(body)
+    except ValueError, e:
+        raise TransportError("Invalid JSON response from %s: %s" % (url, e))
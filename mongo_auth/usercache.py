@@ -0,0 +1,228 @@
+import collections, threading, time
+
+from django.conf import settings
+from django.core import cache as django_cache, exceptions, signals
+
+import bson
+
+from mongoengine import signals as mongoengine_signals
+
+USER_CACHE = False
+USER_CACHE_SIZE = 1000
+USER_CACHE_TIMEOUT = 60 # seconds
+# Name of a cache configured in Django CACHES, shared between processes
+USER_CACHE_BACKEND = None
+# How long to wait for a concurrent load of the same user before loading it ourselves
+LOAD_WAIT_TIMEOUT = 5 # seconds
+
+class LRUCache(object):
+    """
+    Thread-safe mapping of a bounded size which evicts least recently used
+    entries first and expires entries after a timeout.
+    """
+
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.entries.pop(key)
+            except KeyError:
+                return None
+            if expires < time.time():
+                return None
+            # We reinsert the entry to mark it as most recently used
+            self.entries[key] = (expires, value)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (time.time() + self.timeout, value)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class UserCache(object):
+    """
+    Cache of raw user documents with three tiers: a request-local memo, a
+    process-level LRU cache and optionally a shared Django cache.
+
+    Documents are stored BSON-encoded, so every hit decodes into a new
+    object and callers can freely modify what they get. Concurrent loads of
+    the same user in a process are collapsed into one database query.
+    """
+
+    def __init__(self, size, timeout, backend=None):
+        self.timeout = timeout
+        self.local = LRUCache(size, timeout)
+        self.shared = django_cache.get_cache(backend) if backend else None
+        self.request = threading.local()
+        self.lock = threading.Lock()
+        self.loading = {}
+        self.stale = set()
+        self.counters = collections.defaultdict(int)
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        stats['size'] = len(self.local)
+        return stats
+
+    def get_memo(self):
+        if not hasattr(self.request, 'memo'):
+            self.request.memo = {}
+        return self.request.memo
+
+    def clear_memo(self):
+        self.request.memo = {}
+
+    def shared_key(self, key):
+        return 'mongo_auth.user.%s' % key
+
+    def get(self, key, loader):
+        """
+        Returns raw document for the given key, calling ``loader`` with the
+        key to load it on a miss. Returns ``None`` if there is no such document.
+        """
+
+        key = str(key)
+        memo = self.get_memo()
+
+        data = memo.get(key)
+        if data is not None:
+            self.count('request_hits')
+        else:
+            data = self.local.get(key)
+            if data is not None:
+                self.count('local_hits')
+            elif self.shared is not None:
+                data = self.shared.get(self.shared_key(key))
+                if data is not None:
+                    self.count('shared_hits')
+                    self.local.set(key, data)
+            if data is None:
+                self.count('misses')
+                data = self.load(key, loader)
+            if data is None:
+                return None
+            memo[key] = data
+
+        return bson.BSON(data).decode()
+
+    def load(self, key, loader):
+        with self.lock:
+            event = self.loading.get(key)
+            leader = event is None
+            if leader:
+                event = self.loading[key] = threading.Event()
+
+        if not leader:
+            self.count('load_waits')
+            event.wait(LOAD_WAIT_TIMEOUT)
+            data = self.local.get(key)
+            if data is not None:
+                return data
+            # Concurrent load failed, timed out or was invalidated, so we load ourselves
+
+        self.count('loads')
+        try:
+            son = loader(key)
+            data = None if son is None else bson.BSON.encode(son)
+        finally:
+            if leader:
+                with self.lock:
+                    del self.loading[key]
+                    stale = key in self.stale
+                    self.stale.discard(key)
+                event.set()
+
+        if data is not None and not (leader and stale):
+            self.local.set(key, data)
+            if self.shared is not None:
+                self.shared.set(self.shared_key(key), data, self.timeout)
+
+        return data
+
+    def invalidate(self, key):
+        """
+        Removes the given key from all tiers. Other processes drop their
+        local entries only when they expire.
+        """
+
+        key = str(key)
+        with self.lock:
+            if key in self.loading:
+                # Value being loaded might be older than the change which caused invalidation
+                self.stale.add(key)
+        self.get_memo().pop(key, None)
+        self.local.delete(key)
+        if self.shared is not None:
+            self.shared.delete(self.shared_key(key))
+        self.count('invalidations')
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_cache():
+    """
+    Returns user cache, or ``None`` if it is not enabled.
+    """
+
+    global _cache
+
+    if not getattr(settings, 'USER_CACHE', USER_CACHE):
+        return None
+
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if not mongoengine_signals.signals_available:
+                    raise exceptions.ImproperlyConfigured("User cache requires blinker to be installed for invalidation on save.")
+                _cache = UserCache(
+                    getattr(settings, 'USER_CACHE_SIZE', USER_CACHE_SIZE),
+                    getattr(settings, 'USER_CACHE_TIMEOUT', USER_CACHE_TIMEOUT),
+                    getattr(settings, 'USER_CACHE_BACKEND', USER_CACHE_BACKEND),
+                )
+
+    return _cache
+
+def invalidate(key):
+    cache = get_cache()
+    if cache is not None:
+        cache.invalidate(key)
+
+def get_stats():
+    """
+    Returns hit, miss and other counters of the user cache in this process.
+    """
+
+    cache = get_cache()
+    if cache is None:
+        return {}
+    return cache.get_stats()
+
+def clear_request_memo(sender, **kwargs):
+    if _cache is not None:
+        _cache.clear_memo()
+
+signals.request_started.connect(clear_request_memo)
+signals.request_finished.connect(clear_request_memo)
@@ -0,0 +1,120 @@
+from . import models
+
+# Fields which can be read from the raw user document without constructing the user object
+USER_VIEW_FIELDS = ('username', 'first_name', 'last_name', 'email', 'password', 'is_active', 'is_staff', 'is_superuser', 'lazyuser_username', 'email_confirmed', 'language', 'snapshot_version')
+
+# Fields loaded for user views of prefetched users, in addition to view fields and summaries of profile data
+PREFETCH_FIELDS = ('image_url', 'usable_password', 'linked_providers')
+
+def get_prefetch_projection(user_class):
+    """
+    Returns a projection loading only what user views need, for displaying many users.
+    """
+
+    projection = dict.fromkeys(['_cls', '_types'], True)
+    for name, field in user_class._fields.items():
+        if name in models.PROFILE_DATA_SUMMARY_KEYS:
+            for key in models.PROFILE_DATA_SUMMARY_KEYS[name]:
+                projection['%s.%s' % (field.db_field, key)] = True
+        elif name in USER_VIEW_FIELDS or name in PREFETCH_FIELDS:
+            projection[field.db_field] = True
+    return projection
+
+class UserView(object):
+    """
+    Compact read-only view of a raw user document, used as the per-request user
+    instead of constructing the whole user document object.
+
+    Simple fields and methods which only read them are served from the raw
+    document. Accessing any other attribute, setting a field or calling any
+    other method (like ``save``) constructs the user object (upgrades the view)
+    and is delegated to it.
+    """
+
+    __slots__ = ('user_class', 'son', 'loader', 'user', 'backend')
+
+    def __init__(self, user_class, son, loader):
+        object.__setattr__(self, 'user_class', user_class)
+        object.__setattr__(self, 'son', son)
+        object.__setattr__(self, 'loader', loader)
+        object.__setattr__(self, 'user', None)
+        object.__setattr__(self, 'backend', None)
+
+    def get_user(self):
+        if self.user is None:
+            user = self.loader(self.son)
+            if self.backend is not None:
+                user.backend = self.backend
+            object.__setattr__(self, 'user', user)
+        return self.user
+
+    def is_loaded(self):
+        return self.user is not None
+
+    def peek_field(self, name):
+        if self.user is not None:
+            return self.user.peek_field(name)
+        field = self.user_class._fields[name]
+        value = self.son.get(field.db_field)
+        if value is None:
+            value = field.default
+            if callable(value):
+                value = value()
+        return value
+
+    def __getattr__(self, name):
+        # Called only for attributes not defined by the view
+        if self.user is None and name in USER_VIEW_FIELDS and name in self.user_class._fields:
+            return self.peek_field(name)
+        return getattr(self.get_user(), name)
+
+    def __setattr__(self, name, value):
+        if name == 'backend':
+            object.__setattr__(self, name, value)
+            if self.user is None:
+                return
+        setattr(self.get_user(), name, value)
+
+    def __eq__(self, other):
+        return self.pk == getattr(other, 'pk', None)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __unicode__(self):
+        return self.username
+
+    @property
+    def pk(self):
+        return self.son['_id']
+
+    id = pk
+
+    @property
+    def _fields(self):
+        return self.user_class._fields
+
+    # Methods of the user class which read only fields available in the view are called
+    # on the view itself, so that overrides in the user class are respected. If they
+    # access anything else, the view is upgraded.
+
+    def is_authenticated(self):
+        return self.user_class.is_authenticated.im_func(self)
+
+    def is_anonymous(self):
+        return self.user_class.is_anonymous.im_func(self)
+
+    def is_lazyuser(self):
+        return self.user_class.is_lazyuser.im_func(self)
+
+    def has_usable_password(self):
+        return self.user_class.has_usable_password.im_func(self)
+
+    def get_image_url(self):
+        return self.user_class.get_image_url.im_func(self)
+
+    def build_image_url(self):
+        return self.user_class.build_image_url.im_func(self)
@@ -1,4 +1,4 @@
-import json, urllib
+from . import transport
 
 # TODO: Redo all this, it is not really used except on one place
 
@@ -9,7 +9,8 @@ def graph_api_url(fb_request, user=None, token=False):
     
     param = ''
     if user and token:
-        param = '?access_token=%s' % user.facebook_access_token
+        # Stored in the linked account when linked accounts are enabled
+        param = '?access_token=%s' % user.get_access_token('facebook')
     results = 'https://graph.facebook.com/%s/%s' % (fb_request, param)
     return results
 
@@ -18,5 +19,5 @@ def valid_token(user):
     Check to see if a user's Facebook token is still valid.
     """
 
-    data = json.load(urllib.urlopen(graph_api_url('me', user, token=True)))
+    data = transport.get_json(graph_api_url('me', user, token=True))
     return 'error' not in data
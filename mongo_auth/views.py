@@ -1,34 +1,122 @@
-import json, urllib, urlparse
+import functools, json, urllib, urlparse
 
 from django import dispatch, http, shortcuts
 from django.conf import settings
 from django.contrib import auth, messages
-from django.contrib.auth import signals as auth_signals, views as auth_views
-from django.core import urlresolvers
-from django.template import loader
+from django.contrib.auth import forms as auth_forms, hashers, signals as auth_signals, tokens, views as auth_views
+from django.core import signing, urlresolvers
+from django.template import loader, response as template_response
 from django.views import generic as generic_views
 from django.views.decorators import cache, csrf, debug
 from django.views.generic import edit as edit_views
-from django.utils import crypto, http as http_utils
+from django.utils import crypto
 from django.utils.translation import ugettext_lazy as _
 
-import bson
+import mongoengine
 
 import tweepy
 
 import django_browserid
 from django_browserid import views as browserid_views
 
-from . import backends, forms, models
+from . import backends, circuitbreaker, forms, idtoken, models, throttle, transport
 
 FACEBOOK_SCOPE = 'email'
 GOOGLE_SCOPE = 'https://www.googleapis.com/auth/userinfo.email https://www.googleapis.com/auth/userinfo.profile'
+# For how long the user has to complete the login with a third-party provider
+OAUTH_STATE_MAX_AGE = 10 * 60 # seconds
 
-class FacebookLoginView(generic_views.RedirectView):
+class ProviderViewMixin(object):
+    """
+    Fails fast and gracefully, with a message to the user, while the third-party
+    provider is unavailable, so that waiting on it does not tie up workers.
+    """
+
+    # Name of the provider, as used by its circuit breaker
+    provider = None
+    # Name of the provider shown to users
+    provider_name = None
+    # Errors which mean that the provider is unavailable
+    unavailable_errors = (transport.TransportError,)
+
+    def provider_unavailable(self):
+        messages.error(self.request, _("Login with %(provider)s is temporarily unavailable. Please try again later or use another login option.") % {'provider': self.provider_name}, fail_silently=True)
+        return shortcuts.redirect('login')
+
+    def dispatch(self, request, *args, **kwargs):
+        if circuitbreaker.get_breaker(self.provider).is_open():
+            # We do not even send the user to the provider
+            return self.provider_unavailable()
+        try:
+            return super(ProviderViewMixin, self).dispatch(request, *args, **kwargs)
+        except self.unavailable_errors:
+            return self.provider_unavailable()
+
+class ProviderLoginViewMixin(ProviderViewMixin):
+    """
+    Stores state of the login, set by ``get_redirect_url`` into ``self.state``,
+    into a signed and time-limited cookie, instead of into the session.
+    """
+
+    def get(self, request, *args, **kwargs):
+        self.state = None
+        response = super(ProviderLoginViewMixin, self).get(request, *args, **kwargs)
+        if self.state is not None:
+            response.set_signed_cookie(
+                'mongo_auth_state_%s' % self.provider,
+                self.state,
+                salt='mongo_auth.views.%s' % self.provider,
+                max_age=getattr(settings, 'OAUTH_STATE_MAX_AGE', OAUTH_STATE_MAX_AGE),
+                secure=request.is_secure(),
+                httponly=True,
+            )
+        return response
+
+    def make_nonce(self):
+        self.state = crypto.get_random_string(32)
+        return self.state
+
+class ProviderCallbackViewMixin(ProviderViewMixin):
+    """
+    Reads state of the login stored by the login view and removes it.
+    """
+
+    def get_state(self):
+        """
+        Returns stored state, or ``None`` if it is missing, has been tampered with or has expired.
+        """
+
+        try:
+            return self.request.get_signed_cookie(
+                'mongo_auth_state_%s' % self.provider,
+                salt='mongo_auth.views.%s' % self.provider,
+                max_age=getattr(settings, 'OAUTH_STATE_MAX_AGE', OAUTH_STATE_MAX_AGE),
+            )
+        except (KeyError, signing.BadSignature):
+            return None
+
+    def check_nonce(self, nonce):
+        state = self.get_state()
+        return state is not None and nonce is not None and crypto.constant_time_compare(state, nonce)
+
+    def invalid_state(self):
+        messages.error(self.request, _("Login with %(provider)s has expired or is invalid. Please try again.") % {'provider': self.provider_name}, fail_silently=True)
+        response = shortcuts.redirect('login')
+        response.delete_cookie('mongo_auth_state_%s' % self.provider)
+        return response
+
+    def get(self, request, *args, **kwargs):
+        response = super(ProviderCallbackViewMixin, self).get(request, *args, **kwargs)
+        response.delete_cookie('mongo_auth_state_%s' % self.provider)
+        return response
+
+class FacebookLoginView(ProviderLoginViewMixin, generic_views.RedirectView):
     """ 
     This view authenticates the user via Facebook.
     """
 
+    provider = 'facebook'
+    provider_name = 'Facebook'
     permanent = False
 
     def get_redirect_url(self, **kwargs):
@@ -36,22 +124,27 @@ class FacebookLoginView(generic_views.RedirectView):
             'client_id': settings.FACEBOOK_APP_ID,
             'scope': FACEBOOK_SCOPE,
             'redirect_uri': self.request.build_absolute_uri(urlresolvers.reverse('facebook_callback')),
+            'state': self.make_nonce(),
         }
         return 'https://www.facebook.com/dialog/oauth?%s' % urllib.urlencode(args)
 
-class FacebookCallbackView(generic_views.RedirectView):
+class FacebookCallbackView(ProviderCallbackViewMixin, generic_views.RedirectView):
     """ 
     Authentication callback. Redirects user to LOGIN_REDIRECT_URL. 
     """
 
+    provider = 'facebook'
+    provider_name = 'Facebook'
     permanent = False
     # TODO: Redirect users to the page they initially came from
     url = settings.LOGIN_REDIRECT_URL
 
     def get(self, request, *args, **kwargs):
-        # TODO: Add security measures to prevent attackers from sending a redirect to this url with a forged 'code' (you can use 'state' parameter to set a random nonce and store it into session)
-
         if 'code' in request.GET:
+            # Prevents attackers from sending a redirect to this url with a forged 'code'
+            if not self.check_nonce(request.GET.get('state')):
+                return self.invalid_state()
+
             args = {
                 'client_id': settings.FACEBOOK_APP_ID,
                 'client_secret': settings.FACEBOOK_APP_SECRET,
@@ -60,7 +153,7 @@ class FacebookCallbackView(generic_views.RedirectView):
             }
 
             # Retrieve access token
-            response = urlparse.parse_qs(urllib.urlopen('https://graph.facebook.com/oauth/access_token?%s' % urllib.urlencode(args)).read())
+            response = urlparse.parse_qs(circuitbreaker.call(self.provider, transport.request, 'GET', 'https://graph.facebook.com/oauth/access_token', params=args))
             # TODO: Handle error, what if response does not contain access token?
             access_token = response['access_token'][0]
 
@@ -75,11 +168,14 @@ class FacebookCallbackView(generic_views.RedirectView):
             # TODO: Use information provided by Facebook as to why the login was not successful
             return super(FacebookCallbackView, self).get(request, *args, **kwargs)
 
-class TwitterLoginView(generic_views.RedirectView):
+class TwitterLoginView(ProviderLoginViewMixin, generic_views.RedirectView):
     """
     This view authenticates the user via Twitter.
     """
 
+    provider = 'twitter'
+    provider_name = 'Twitter'
+    unavailable_errors = (transport.TransportError, tweepy.TweepError)
     permanent = False
 
     def get_redirect_url(self, **kwargs):
@@ -88,15 +184,19 @@ class TwitterLoginView(generic_views.RedirectView):
             settings.TWITTER_CONSUMER_SECRET,
             self.request.build_absolute_uri(urlresolvers.reverse('twitter_callback')),
         )
-        redirect_url = twitter_auth.get_authorization_url(signin_with_twitter=True)
-        self.request.session['request_token'] = twitter_auth.request_token
+        redirect_url = circuitbreaker.call(self.provider, twitter_auth.get_authorization_url, signin_with_twitter=True)
+        # Request token is needed in the callback, we keep it in a signed cookie
+        self.state = json.dumps([twitter_auth.request_token.key, twitter_auth.request_token.secret])
         return redirect_url
 
-class TwitterCallbackView(generic_views.RedirectView):
+class TwitterCallbackView(ProviderCallbackViewMixin, generic_views.RedirectView):
     """
     Authentication callback. Redirects user to TWITTER_LOGIN_REDIRECT.
     """
 
+    provider = 'twitter'
+    provider_name = 'Twitter'
+    unavailable_errors = (transport.TransportError, tweepy.TweepError)
     permanent = False
     # TODO: Redirect users to the page they initially came from
     url = settings.LOGIN_REDIRECT_URL
@@ -104,11 +204,16 @@ class TwitterCallbackView(generic_views.RedirectView):
     def get(self, request, *args, **kwargs):
         if 'oauth_verifier' in request.GET:
             oauth_verifier = request.GET['oauth_verifier']
+            state = self.get_state()
+            if state is None:
+                return self.invalid_state()
+            request_token_key, request_token_secret = json.loads(state)
+            if not crypto.constant_time_compare(request_token_key, request.GET.get('oauth_token', '')):
+                return self.invalid_state()
+
             twitter_auth = tweepy.OAuthHandler(settings.TWITTER_CONSUMER_KEY, settings.TWITTER_CONSUMER_SECRET)
-            request_token = request.session.pop('request_token')
-            assert request_token.key == request.GET['oauth_token']
-            twitter_auth.set_request_token(request_token.key, request_token.secret)
-            twitter_auth.get_access_token(verifier=oauth_verifier)
+            twitter_auth.set_request_token(request_token_key, request_token_secret)
+            circuitbreaker.call(self.provider, twitter_auth.get_access_token, verifier=oauth_verifier)
 
             user = auth.authenticate(twitter_access_token=twitter_auth.access_token, request=request)
             assert user.is_authenticated()
@@ -121,37 +226,50 @@ class TwitterCallbackView(generic_views.RedirectView):
             # TODO: Use information provided from twitter as to why the login was not successful
             return super(TwitterCallbackView, self).get(request, *args, **kwargs)
 
-class GoogleLoginView(generic_views.RedirectView):
+class GoogleLoginView(ProviderLoginViewMixin, generic_views.RedirectView):
     """
     This view authenticates the user via Google.
     """
 
+    provider = 'google'
+    provider_name = 'Google'
     permanent = False
 
     def get_redirect_url(self, **kwargs):
         args = {
             'client_id': settings.GOOGLE_CLIENT_ID,
-            'scope': GOOGLE_SCOPE,
+            'scope': self.get_scope(),
             'redirect_uri': self.request.build_absolute_uri(urlresolvers.reverse('google_callback')),
             'response_type': 'code',
             'access_type': 'online',
             'approval_prompt': 'auto',
+            'state': self.make_nonce(),
         }
         return 'https://accounts.google.com/o/oauth2/auth?%s' % urllib.urlencode(args)
 
-class GoogleCallbackView(generic_views.RedirectView):
+    def get_scope(self):
+        if getattr(settings, 'GOOGLE_VERIFY_ID_TOKEN', idtoken.GOOGLE_VERIFY_ID_TOKEN):
+            # We want an ID token in the token endpoint response
+            return 'openid %s' % GOOGLE_SCOPE
+        return GOOGLE_SCOPE
+
+class GoogleCallbackView(ProviderCallbackViewMixin, generic_views.RedirectView):
     """
     Authentication callback. Redirects user to GOOGLE_REDIRECT_URL.
     """
 
+    provider = 'google'
+    provider_name = 'Google'
     permanent = False
     # TODO: Redirect users to the page they initially came from
     url = settings.LOGIN_REDIRECT_URL
 
     def get(self, request, *args, **kwargs):
-        # TODO: Add security measures to prevent attackers from sending a redirect to this url with a forged 'code' (you can use 'state' parameter to set a random nonce and store it into session)
-
         if 'code' in request.GET:
+            # Prevents attackers from sending a redirect to this url with a forged 'code'
+            if not self.check_nonce(request.GET.get('state')):
+                return self.invalid_state()
+
             args = {
                 'client_id': settings.GOOGLE_CLIENT_ID,
                 'client_secret': settings.GOOGLE_CLIENT_SECRET,
@@ -160,11 +278,14 @@ class GoogleCallbackView(generic_views.RedirectView):
                 'grant_type': 'authorization_code',
             }
 
-            response = json.load(urllib.urlopen('https://accounts.google.com/o/oauth2/token', urllib.urlencode(args)))
+            response = circuitbreaker.call(self.provider, transport.post_json, 'https://accounts.google.com/o/oauth2/token', args)
             # TODO: Handle error, what if response does not contain access token?
             access_token = response['access_token']
 
-            user = auth.authenticate(google_access_token=access_token, request=request)
+            # If enabled, verified ID token saves us a request for profile data
+            profile_data = idtoken.get_google_profile_data(response)
+
+            user = auth.authenticate(google_access_token=access_token, google_profile_data=profile_data, request=request)
             assert user.is_authenticated()
 
             auth.login(request, user)
@@ -175,11 +296,13 @@ class GoogleCallbackView(generic_views.RedirectView):
             # TODO: Use information provided from Google as to why the login was not successful
             return super(GoogleCallbackView, self).get(request, *args, **kwargs)
 
-class FoursquareLoginView(generic_views.RedirectView):
+class FoursquareLoginView(ProviderLoginViewMixin, generic_views.RedirectView):
     """
     This view authenticates the user via Foursquare.
     """
 
+    provider = 'foursquare'
+    provider_name = 'Foursquare'
     permanent = False
 
     def get_redirect_url(self, **kwargs):
@@ -187,20 +310,27 @@ class FoursquareLoginView(generic_views.RedirectView):
             'client_id': settings.FOURSQUARE_CLIENT_ID,
             'redirect_uri': self.request.build_absolute_uri(urlresolvers.reverse('foursquare_callback')),
             'response_type': 'code',
+            'state': self.make_nonce(),
         }
         return 'https://foursquare.com/oauth2/authenticate?%s' % urllib.urlencode(args)
 
-class FoursquareCallbackView(generic_views.RedirectView):
+class FoursquareCallbackView(ProviderCallbackViewMixin, generic_views.RedirectView):
     """
     Authentication callback. Redirects user to LOGIN_REDIRECT_URL.
     """
 
+    provider = 'foursquare'
+    provider_name = 'Foursquare'
     permanent = False
     # TODO: Redirect users to the page they initially came from
     url = settings.LOGIN_REDIRECT_URL
 
     def get(self, request, *args, **kwargs):
         if 'code' in request.GET:
+            # Prevents attackers from sending a redirect to this url with a forged 'code'
+            if not self.check_nonce(request.GET.get('state')):
+                return self.invalid_state()
+
             args = {
                 'client_id': settings.FOURSQUARE_CLIENT_ID,
                 'client_secret': settings.FOURSQUARE_CLIENT_SECRET,
@@ -209,7 +339,7 @@ class FoursquareCallbackView(generic_views.RedirectView):
                 'grant_type': 'authorization_code',
             }
 
-            response = json.load(urllib.urlopen('https://foursquare.com/oauth2/access_token', urllib.urlencode(args)))
+            response = circuitbreaker.call(self.provider, transport.post_json, 'https://foursquare.com/oauth2/access_token', args)
             # TODO: Handle error, what if response does not contain access token?
             access_token = response['access_token']
 
@@ -269,12 +399,18 @@ class RegistrationView(edit_views.FormView):
 
     def form_valid(self, form):
         new_user = self.get_user_class()(**self.object_data(form))
-        new_user.set_password(form.cleaned_data['password2'])
-        new_user.save()
-        # We update user with authentication data
-        newuser = auth.authenticate(username=form.cleaned_data['username'], password=form.cleaned_data['password2'])
-        assert newuser is not None, form.cleaned_data['username']
-        auth.login(self.request, newuser)
+        new_user.password = hashers.make_password(form.cleaned_data['password2'])
+        try:
+            new_user.save(force_insert=True)
+        except mongoengine.OperationError, e:
+            if not backends.is_duplicate_key_error(e):
+                raise
+            # Username has been taken after the form checked it, unique index caught it
+            form._errors['username'] = form.error_class([_("A user with that username already exists.")])
+            return self.form_invalid(form)
+        # We know the user and its password, so we do not have to authenticate it again
+        new_user.backend = '%s.%s' % (backends.MongoEngineBackend.__module__, backends.MongoEngineBackend.__name__)
+        auth.login(self.request, new_user)
         messages.success(self.request, _("Registration has been successful."))
         return super(RegistrationView, self).form_valid(form)
 
@@ -293,14 +429,20 @@ class AccountChangeView(edit_views.FormView):
     form_class = forms.AccountChangeForm
     success_url = urlresolvers.reverse_lazy('account')
 
+    def account_data(self, form):
+        data = {
+            'first_name': form.cleaned_data['first_name'],
+            'last_name': form.cleaned_data['last_name'],
+        }
+        if self.request.user.email != form.cleaned_data['email']:
+            data.update({
+                'email_confirmed': False,
+                'email': form.cleaned_data['email'],
+            })
+        return data
+
     def form_valid(self, form):
-        user = self.request.user
-        user.first_name = form.cleaned_data['first_name']
-        user.last_name = form.cleaned_data['last_name']
-        if user.email != form.cleaned_data['email']:
-            user.email_confirmed = False
-            user.email = form.cleaned_data['email']
-        user.save()
+        self.request.user.update_fields(**self.account_data(form))
         messages.success(self.request, _("Your account has been successfully updated."))
         return super(AccountChangeView, self).form_valid(form)
 
@@ -367,8 +509,7 @@ class EmailConfirmationSendToken(edit_views.FormView):
         subject = ''.join(subject.splitlines())
         email = loader.render_to_string('mongo_auth/confirmation_email.txt', context)
 
-        user.email_confirmation_token = models.EmailConfirmationToken(value=confirmation_token)
-        user.save()
+        user.update_fields(email_confirmation_token=models.EmailConfirmationToken(value=confirmation_token))
         user.email_user(subject, email, allow_unconfirmed=True)
 
         messages.success(self.request, _("Confirmation e-mail has been sent to your e-mail address."))
@@ -384,9 +525,7 @@ class EmailConfirmationProcessToken(generic_views.FormView):
     success_url = urlresolvers.reverse_lazy('account')
 
     def form_valid(self, form):
-        user = self.request.user
-        user.email_confirmed = True
-        user.save()
+        self.request.user.update_fields(email_confirmed=True)
         messages.success(self.request, _("You have successfully confirmed your e-mail address."))
         return super(EmailConfirmationProcessToken, self).form_valid(form)
 
@@ -403,6 +542,17 @@ class EmailConfirmationProcessToken(generic_views.FormView):
     def get_form(self, form_class):
         return form_class(self.request.user, **self.get_form_kwargs())
 
+def login(request, authentication_form=forms.AuthenticationForm, *args, **kwargs):
+    """
+    Same as Django's view, but rejects login attempts over the limit for the client
+    IP address. Django does not pass the request to the form when it is submitted,
+    so we count the attempt here.
+    """
+
+    if request.method == 'POST' and not throttle.allow('ip', throttle.get_client_ip(request)):
+        authentication_form = functools.partial(authentication_form, throttled=True)
+    return auth_views.login(request, authentication_form=authentication_form, *args, **kwargs)
+
 def logout(request):
     """
     After user logouts, redirect her back to the page she came from.
@@ -422,28 +572,40 @@ def password_reset(request, post_reset_redirect=None, *args, **kwargs):
 
 @debug.sensitive_post_parameters()
 @cache.never_cache
-def password_reset_confirm(request, *args, **kwargs):
-    old_base36_to_int = http_utils.base36_to_int
-    old_user = auth_views.User
-
-    def base36_to_objectid(s):
-        if 13 < len(s) <= 26:
-            return bson.ObjectId(hex(int(s, 36))[2:-1])
-        else:
-            return old_base36_to_int(s)
+def password_reset_confirm(request, uidb36=None, token=None, template_name='registration/password_reset_confirm.html', token_generator=tokens.default_token_generator, set_password_form=auth_forms.SetPasswordForm, post_reset_redirect=None, current_app=None, extra_context=None):
+    """
+    Same as Django's view, but for users identified by ObjectIds.
+    """
 
-    http.base36_to_int = base36_to_objectid
-    auth_views.base36_to_int = base36_to_objectid
-    auth_views.User = backends.User
+    assert uidb36 is not None and token is not None # Checked by URLconf
+    if post_reset_redirect is None:
+        post_reset_redirect = urlresolvers.reverse('django.contrib.auth.views.password_reset_complete')
     try:
-        result = auth_views.password_reset_confirm(request, *args, **kwargs)
-        if isinstance(result, http.HttpResponseRedirect):
-            messages.success(request, _("Your password has been set. You may go ahead and login now."))
-        return result
-    finally:
-        http.base36_to_int = old_base36_to_int
-        auth_views.base36_to_int = old_base36_to_int
-        auth_views.User = old_user
+        user = backends.User.objects.get(pk=forms.base36_to_objectid(uidb36))
+    except (ValueError, backends.User.DoesNotExist):
+        user = None
+
+    if user is not None and token_generator.check_token(user, token):
+        validlink = True
+        if request.method == 'POST':
+            form = set_password_form(user, request.POST)
+            if form.is_valid():
+                form.save()
+                messages.success(request, _("Your password has been set. You may go ahead and login now."))
+                return http.HttpResponseRedirect(post_reset_redirect)
+        else:
+            form = set_password_form(None)
+    else:
+        validlink = False
+        form = None
+
+    context = {
+        'form': form,
+        'validlink': validlink,
+    }
+    if extra_context is not None:
+        context.update(extra_context)
+    return template_response.TemplateResponse(request, template_name, context, current_app=current_app)
 
 @dispatch.receiver(auth_signals.user_logged_in)
 def user_login_message(sender, request, user, **kwargs):
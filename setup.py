@@ -38,9 +38,16 @@ if __name__ == '__main__':
         install_requires = [
             'Django>=1.3',
             'mongoengine>=0.6.11',
+            'requests>=2.18',
             'tweepy>=1.9',
             'django-browserid>=0.6',
             'django-missing>=0.1.10',
             'django-sekizai>=0.5'
         ],
+        extras_require = {
+            'idtoken': [
+                'PyJWT>=1.5',
+                'cryptography',
+            ],
+        },
     )